@@ -0,0 +1,1007 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, array engine
+Struct-of-arrays population used by ProxyModel(engine="arrays"). Instead of
+one ProxyAgent object per agent, every agent property is stored in one
+contiguous numpy array indexed by agent number (= unique_id).
+"""
+
+import numpy as np
+from scipy.special import erf
+from mesa.datacollection import DataCollector
+
+''' effort changes tried by optimize_effort, practice changes (°) under agency
+(also compiled into ProxyKernels) '''
+TEST_LIST = np.array([-10, -5, -1, -0.5, -0.1,
+                      0, 0.1, 0.5, 1, 5, 10])
+CHANGE_ANGLE = np.array([-5, -1, 0, 1, 5])
+
+
+''' Prospect functions: utility/disutility from the prospect of winning/
+loosing competition, computed from the distance own_proxy-survival_threshold
+(arrays of any shape). Selected by ProxyModel(prospect=name). '''
+PROSPECTS = {}
+
+
+def register_prospect(name):
+    """ decorator adding a prospect function to PROSPECTS """
+    def register(function):
+        PROSPECTS[name] = function
+        return function
+    return register
+
+
+@register_prospect("kahneman_tversky")
+def kahneman_tversky_prospect(distance, model):
+    """ Kahneman Tversky Prospect: |distance|^prospect_exponent,
+    losses weighted by loss_aversion """
+    prospect = np.float_power(abs(distance), model.prospect_exponent).astype(
+        distance.dtype, copy=False)
+    return np.where(distance < 0, -prospect * model.loss_aversion, prospect)
+
+
+@register_prospect("mcdermott")
+def mcdermott_prospect(distance, model):
+    """ McDermott Prospect: prospect_scale*erf(distance/survival_uncertainty),
+    losses weighted by loss_aversion """
+    prospect = model.prospect_scale * erf(distance/model.survival_uncertainty)
+    return np.where(distance < 0, -abs(prospect) * model.loss_aversion,
+                    prospect)
+
+
+@register_prospect("step")
+def step_prospect(distance, model):
+    """ Step Prospect: 1 when surviving, -1 when loosing competition """
+    return np.where(distance < 0, -1., 1.)
+
+
+@register_prospect("linear")
+def linear_prospect(distance, model):
+    """ distance to the survival threshold itself as prospect """
+    return distance * 1.
+
+
+def gaming_angles(practice):
+    """ candidate practice angles for individual learning (gaming) """
+    own_practice = practice/np.pi*180
+    return np.deg2rad(own_practice - CHANGE_ANGLE.astype(own_practice.dtype))
+
+
+def survival_rank(competition, size):
+    """ index of the survival threshold int(competition*size)-1 among size
+    ordered proxies (counted from the top for competition 0); competition
+    and size may be arrays """
+    k = np.multiply(competition, size).astype(int)-1
+    if np.ndim(k):
+        return np.where(k < 0, k + size, k)
+    return int(k + size if k < 0 else k)
+
+
+''' ProxyRankIndex.replace: fewer entries are moved one by one '''
+REPLACE_ONE_BY_ONE = 8
+
+
+class ProxyRankIndex:
+    """
+    Sorted copy of the proxies of all agents, kept up to date while agents
+    commit new proxies one after another. It answers the survival threshold
+    ordered[int(competition*N)-1] without sorting the population again.
+    """
+    def __init__(self, proxies):
+        self.ordered = np.sort(proxies)
+
+    def __len__(self):
+        return len(self.ordered)
+
+    def update(self, old_proxy, new_proxy):
+        """ replace one entry old_proxy by new_proxy (binary search for both
+        positions, then shift the entries in between by one) """
+        ordered = self.ordered
+        i = np.searchsorted(ordered, old_proxy)
+        j = np.searchsorted(ordered, new_proxy)
+        if j > i:
+            ordered[i:j-1] = ordered[i+1:j]
+            ordered[j-1] = new_proxy
+        else:
+            ordered[j+1:i+1] = ordered[j:i]
+            ordered[j] = new_proxy
+
+    def replace(self, old_proxies, new_proxies):
+        """ replace the entries old_proxies by new_proxies (arrays): one
+        after another (see update) for a few entries, otherwise all at once
+        by deleting the old entries and merging in the new ones """
+        if len(new_proxies) < REPLACE_ONE_BY_ONE:
+            for old_proxy, new_proxy in zip(old_proxies, new_proxies):
+                self.update(old_proxy, new_proxy)
+            return
+        old_proxies = np.sort(old_proxies)
+        ''' one entry per old proxy, also among equal proxies '''
+        position = (np.searchsorted(self.ordered, old_proxies)
+                    + np.arange(len(old_proxies))
+                    - np.searchsorted(old_proxies, old_proxies))
+        kept = np.delete(self.ordered, position)
+        new_proxies = np.sort(new_proxies)
+        self.ordered = np.insert(kept, np.searchsorted(kept, new_proxies),
+                                 new_proxies)
+
+    def rank(self, competition):
+        """ index of the survival threshold in the ordered proxies """
+        return survival_rank(competition, len(self))
+
+    def threshold(self, competition):
+        """ survival threshold of the current population """
+        return self.ordered[self.rank(competition)]
+
+    def select(self, rows):
+        """ index of a subset of the agents (the same for all agents) """
+        return self
+
+    def neighbours(self, own_proxy, competition):
+        """ proxies just below and at the survival threshold among the other
+        agents (without the entry own_proxy, which may be an array) """
+        ordered = self.ordered
+        n = len(self)
+        k = self.rank(competition)
+        ''' position of the own entry, the others are ordered without it '''
+        own = np.searchsorted(ordered, own_proxy)
+        lower = ordered[k-1 + (k-1 >= own)] if k > 0 else -np.inf
+        upper = ordered[k + (k >= own)] if k < n-1 else np.inf
+        return lower, upper
+
+    def leave_one_out(self, own_proxy, competition, proxy):
+        """ survival threshold if the entry own_proxy were replaced by proxy
+        (own_proxy and proxy may be arrays that broadcast) """
+        lower, upper = self.neighbours(own_proxy, competition)
+        return np.maximum(lower, np.minimum(proxy, upper))
+
+
+def per_row(value, like):
+    """ value shaped to broadcast against the array like: a shared (scalar)
+    value as it is, an array with one value per row of like (e.g. per
+    replicate parameters of ProxyEnsemble) along its leading axis """
+    if np.ndim(value) == 0:
+        return value
+    value = np.asarray(value)
+    return value.reshape(value.shape + (1,)*(np.ndim(like) - value.ndim))
+
+
+def select_rows(value, rows):
+    """ the given rows of a per row value: an array, or a model or index
+    with a select method; shared (scalar) values are returned as they are """
+    if hasattr(value, "select"):
+        return value.select(rows)
+    return value if np.ndim(value) == 0 else value[rows]
+
+
+def candidate_angles(practice, agency, learned=None):
+    """ practice angles tried by each agent (one row per agent, nan where
+    unused); agency: boolean array of agents with agency in this step,
+    learned: practices of their neighbours under social learning (one row
+    per agent with agency), gaming angles otherwise """
+    if not agency.any():
+        return practice[:, np.newaxis]
+    if learned is None:
+        angles = np.full((len(practice), len(CHANGE_ANGLE)), np.nan,
+                         dtype=practice.dtype)
+        angles[:, 0] = practice
+        angles[agency] = gaming_angles(practice[agency, np.newaxis])
+        return angles
+    angles = np.full((len(practice), 1 + learned.shape[1]), np.nan,
+                     dtype=practice.dtype)
+    angles[:, 0] = practice
+    angles[agency, 1:] = learned
+    return angles
+
+
+def trig_terms(practice, model):
+    """ cos(practice), sin(practice) and cos(goal_angle - practice), the
+    terms of proxy, goal_oc and goal (cached per agent, recomputed only when
+    practice changes) """
+    return (np.cos(practice), np.sin(practice),
+            np.cos(per_row(model.goal_angle, practice) - practice))
+
+
+def candidate_utility(effort, cos_goal, proxy, survival_threshold, model,
+                      goal_scale, talent):
+    """ utility of candidate efforts (arrays that broadcast, cos_goal:
+    cos(goal_angle - practice) of their practices):
+    prospect + goal value - effort cost """
+    competing = per_row(np.greater(model.competition, 0), proxy)
+    if np.all(competing):
+        prospect = PROSPECTS[model.prospect](proxy-survival_threshold, model)
+    elif np.any(competing):
+        prospect = np.where(competing, PROSPECTS[model.prospect](
+            proxy-survival_threshold, model), 0.)
+    else:
+        prospect = np.zeros(np.shape(proxy))  # no competition
+
+    goal = cos_goal * effort
+    cost = np.float_power(effort, 2).astype(effort.dtype, copy=False)
+    return prospect + per_row(goal_scale, goal)*goal - cost/talent
+
+
+def best_candidates(old_effort, old_practice, angles, own_proxy, index,
+                    model, goal_scale, talent, trig=None):
+    """ Evaluates the whole candidate grid (angles x TEST_LIST efforts) of
+    several agents at once (one row per agent) and returns utility, effort
+    and practice of the best candidate of each agent.
+
+    Candidates are ranked in the order the original nested loop visited them
+    (angle by angle, effort by effort) and, as in that loop, every candidate
+    sees the agent's own entry in the population at the proxy of the
+    previously evaluated candidate (the committed proxy for the first one).
+    The result is therefore identical to evaluating the candidates one by
+    one. index: ProxyRankIndex the agents compete in.
+    trig: cached cos(practice) and cos(goal_angle - practice) of the
+    agents, used when they only try their current practice. """
+    n = len(angles)
+    rows = np.arange(n)
+    test_list = TEST_LIST.astype(np.promote_types(old_effort.dtype,
+                                                  np.float32), copy=False)
+    effort = np.repeat(old_effort[:, np.newaxis] + test_list, angles.shape[1],
+                       axis=0).reshape(n, -1)
+    practice = np.repeat(angles, len(TEST_LIST), axis=1)
+    valid = (effort > 0) & ~np.isnan(practice)
+
+    ''' cos terms once per angle instead of once per candidate '''
+    if trig is not None and angles.shape[1] == 1:
+        cos_practice = trig[0][:, np.newaxis]
+        cos_goal = trig[1][:, np.newaxis]
+    else:
+        cos_practice, _, cos_goal = trig_terms(angles, model)
+        cos_practice = np.repeat(cos_practice, len(TEST_LIST), axis=1)
+        cos_goal = np.repeat(cos_goal, len(TEST_LIST), axis=1)
+    proxy = cos_practice * effort
+    position = np.where(valid, np.arange(valid.shape[1]), -1)
+    previous = np.maximum.accumulate(position, axis=1)[:, :-1]
+    own_entry = np.take_along_axis(proxy, np.maximum(previous, 0), axis=1)
+    own_entry = np.where(previous >= 0, own_entry, own_proxy[:, np.newaxis])
+    own_entry = np.concatenate((own_proxy[:, np.newaxis], own_entry), axis=1)
+    rel_surv_thresh = model.competition
+    survival_threshold = index.leave_one_out(own_proxy[:, np.newaxis],
+                                             rel_surv_thresh, own_entry)
+
+    utility = candidate_utility(effort, cos_goal, proxy, survival_threshold,
+                                model, goal_scale, talent[:, np.newaxis])
+
+    if np.isnan(utility[valid]).any():
+        print('error: utility is nan')
+    utility = np.where(valid & ~np.isnan(utility), utility, -np.inf)
+    best = np.argmax(utility, axis=1)
+    max_utility = utility[rows, best]
+    found = max_utility > -1000
+    return (np.where(found, max_utility, -1000),
+            np.where(found, effort[rows, best], 0),
+            np.where(found, practice[rows, best], old_practice))
+
+
+def grid_candidates(old_effort, old_practice, agency, own_proxy, index,
+                    model, goal_scale, talent, learned=None, trig=None):
+    """ optimizer="grid": best_candidates of several agents, with the same
+    arguments as solve_candidates (see candidate_angles). Agents without
+    agency only try their current practice and are evaluated apart from
+    those with agency, instead of padding their rows to the whole grid. """
+    if agency.any() and not agency.all():
+        parts = []
+        rows = (np.flatnonzero(~agency), np.flatnonzero(agency))
+        for subset, subset_learned in zip(rows, (None, learned)):
+            parts.append(grid_candidates(
+                old_effort[subset], old_practice[subset], agency[subset],
+                own_proxy[subset], index.select(subset),
+                select_rows(model, subset), select_rows(goal_scale, subset),
+                talent[subset], subset_learned,
+                None if trig is None else tuple(x[subset] for x in trig)))
+        order = np.concatenate(rows)
+        results = []
+        for values in zip(*parts):
+            values = np.concatenate(values)
+            results.append(np.empty_like(values))
+            results[-1][order] = values
+        return tuple(results)
+    angles = candidate_angles(old_practice, agency, learned)
+    return best_candidates(old_effort, old_practice, angles, own_proxy, index,
+                           model, goal_scale, talent, trig)
+
+
+''' agents optimized together in one vectorized call (synchronous update):
+bounds the memory of the candidate arrays, which hold up to 55 candidates
+per agent '''
+CHUNK_SIZE = 2**14
+
+''' active set (ProxyModel(active_set=True)): settled agents farther than
+this from the survival threshold (proxy units, the smallest effort step of
+TEST_LIST) keep their best response until the threshold moved by as much '''
+ACTIVE_WINDOW = 0.1
+
+
+''' optimizer="solve": tolerance of the solved effort and practice (rad),
+the most steps a search may take and the intervals each search scans first '''
+SOLVE_TOLERANCE = 1e-3
+SOLVE_STEPS = 100
+SOLVE_SCAN = 16
+
+
+def brent_maximum(function, a, b, tolerance=SOLVE_TOLERANCE,
+                  scan=SOLVE_SCAN):
+    """ maximum of function on each interval [a, b] (arrays, one search per
+    element). The interval is scanned at scan+1 evenly spaced points (ends
+    included), then Brent's method searches between the neighbours of the
+    best of them, as scipy.optimize.fminbound: a parabola through the last
+    three points where it falls well inside the interval, a golden section
+    step otherwise. Returns the maximum and its argument, the best of the
+    scan and the search: the ends count even where the function jumps or
+    has an infinite slope there, and a function with several local maxima
+    is searched around the highest point of the scan.
+    function(x, rows) evaluates x at the given rows (leading axis), only the
+    rows with a search left are evaluated. Every search stops on its own, so
+    its result does not depend on the other searches it is evaluated with. """
+    golden = (3 - np.sqrt(5)) / 2
+    a, b = (x.copy() for x in np.broadcast_arrays(a, b))
+    sqrt_eps = np.sqrt(np.finfo(a.dtype).eps)
+    every = np.arange(len(a))
+    points = [a + (b - a)*(i/scan) for i in range(scan)] + [b]
+    values = [-function(x, every) for x in points]
+    values = np.stack([np.where(np.isnan(f), np.inf, f) for f in values])
+    points = np.stack(points)
+    at = np.argmin(values, axis=0)[np.newaxis]
+    best, f_best = (np.take_along_axis(x, at, axis=0)[0]
+                    for x in (points, values))
+    a, b = (np.take_along_axis(points, np.clip(at + step, 0, scan), axis=0)[0]
+            for step in (-1, 1))
+    x = a + golden*(b - a)
+    fx = -function(x, every)
+    fx = np.where(np.isnan(fx), np.inf, fx)
+    v, w = x.copy(), x.copy()
+    fv, fw = fx.copy(), fx.copy()
+    d, e = np.zeros(x.shape), np.zeros(x.shape)
+    for _ in range(SOLVE_STEPS):
+        middle = (a + b) / 2
+        tol1 = sqrt_eps*abs(x) + tolerance/3
+        tol2 = 2*tol1
+        searching = abs(x - middle) > tol2 - (b - a)/2
+        rows = np.flatnonzero(searching.reshape(len(x), -1).any(axis=1))
+        if not len(rows):
+            break
+        ''' parabola through x, w and v '''
+        r = (x - w)*(fx - fv)
+        q = (x - v)*(fx - fw)
+        p = (x - v)*q - (x - w)*r
+        q = 2*(q - r)
+        p = np.where(q > 0, -p, p)
+        q = abs(q)
+        parabolic = ((abs(e) > tol1) & (abs(p) < abs(q*e/2))
+                     & (p > q*(a - x)) & (p < q*(b - x)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(parabolic, p/q,
+                            golden*np.where(x >= middle, a - x, b - x))
+        towards_middle = np.where(middle >= x, tol1, -tol1)
+        step = np.where(parabolic & ((x + step - a < tol2)
+                                     | (b - x - step < tol2)),
+                        towards_middle, step)
+        e = np.where(searching, np.where(parabolic, d, np.where(
+            x >= middle, a - x, b - x)), e)
+        d = np.where(searching, step, d)
+        u = x + np.where(d >= 0, 1, -1)*np.maximum(abs(d), tol1)
+        fu = fx.copy()
+        fu[rows] = -function(u[rows], rows)
+        fu = np.where(np.isnan(fu), np.inf, fu)
+
+        ''' narrow the interval and keep the three best points '''
+        better = searching & (fu <= fx)
+        worse = searching & ~(fu <= fx)
+        a = np.where(better & (u >= x) | worse & (u < x),
+                     np.where(better, x, u), a)
+        b = np.where(better & (u < x) | worse & (u >= x),
+                     np.where(better, x, u), b)
+        second = worse & ((fu <= fw) | (w == x))
+        third = worse & ~second & ((fu <= fv) | (v == x) | (v == w))
+        v, fv = (np.where(better | second, w, np.where(third, u, v)),
+                 np.where(better | second, fw, np.where(third, fu, fv)))
+        w, fw = (np.where(better, x, np.where(second, u, w)),
+                 np.where(better, fx, np.where(second, fu, fw)))
+        x, fx = np.where(better, u, x), np.where(better, fu, fx)
+    better = f_best < fx
+    return -np.where(better, f_best, fx), np.where(better, best, x)
+
+
+def solve_effort(practice, old_effort, own_proxy, index, model, goal_scale,
+                 talent, trig=None):
+    """ utility maximizing effort of agents (rows) at the given practices
+    (columns) against the other agents in index; returns utility, effort.
+    Efforts are searched within the range the grid reaches in one step,
+    old effort ± the largest change of TEST_LIST (and not below 0). The
+    proxy crosses the neighbours of the survival threshold at two efforts,
+    in between and beyond them the utility is smooth. Each of the three
+    pieces is searched by brent_maximum (ends included) and the best of them
+    is taken.
+    trig: cached cos(practice) and cos(goal_angle - practice), if known. """
+    if trig is None:
+        cos_practice, _, cos_goal = trig_terms(practice, model)
+    else:
+        cos_practice, cos_goal = trig
+    lower, upper = index.neighbours(own_proxy, model.competition)
+    reach = float(np.max(np.abs(TEST_LIST)))
+    bottom = np.broadcast_to(np.maximum(old_effort - reach, 0),
+                             cos_practice.shape)[..., np.newaxis]
+    top = np.broadcast_to(old_effort + reach,
+                          cos_practice.shape)[..., np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossings = np.stack((lower/cos_practice, upper/cos_practice),
+                             axis=-1)
+    crossings = np.clip(np.where(np.isfinite(crossings), crossings, bottom),
+                        bottom, top)
+    edges = np.sort(np.concatenate((bottom, crossings, top), axis=-1),
+                    axis=-1)
+
+    cos_practice, cos_goal, lower, upper, talent = np.broadcast_arrays(
+        cos_practice[..., np.newaxis], cos_goal[..., np.newaxis],
+        np.asarray(lower)[..., np.newaxis], np.asarray(upper)[..., np.newaxis],
+        talent[..., np.newaxis])
+
+    def utility(effort, rows=slice(None)):
+        proxy = cos_practice[rows] * effort
+        survival_threshold = np.maximum(lower[rows],
+                                        np.minimum(proxy, upper[rows]))
+        return candidate_utility(effort, cos_goal[rows], proxy,
+                                 survival_threshold, select_rows(model, rows),
+                                 select_rows(goal_scale, rows), talent[rows])
+
+    utilities, effort = brent_maximum(utility, edges[..., :-1],
+                                      edges[..., 1:])
+    if np.isnan(utilities).any():
+        print('error: utility is nan')
+    utilities = np.where(np.isnan(utilities), -np.inf, utilities)
+    best = np.argmax(utilities, axis=-1)[..., np.newaxis]
+    return (np.take_along_axis(utilities, best, axis=-1)[..., 0],
+            np.take_along_axis(effort, best, axis=-1)[..., 0])
+
+
+def solve_candidates(old_effort, old_practice, agency, own_proxy, index,
+                     model, goal_scale, talent, learned=None, trig=None):
+    """ optimizer="solve": best response of several agents at once, same
+    arguments and results as best_candidates but with agency (boolean
+    array) instead of candidate angles. Effort is solved for directly (see
+    solve_effort). Agents with agency also solve for their practice within
+    the gaming range of one step (±5°, see CHANGE_ANGLE): the best effort is
+    solved at the gaming angles, then the practice by brent_maximum between
+    the neighbours of the best one. Under social learning (learned:
+    practices of the neighbours of the agents with agency, one row each) the
+    best effort is solved at the own and the learned practices instead.
+    trig: see best_candidates. """
+    old_effort, old_practice, own_proxy, talent = (
+        x[:, np.newaxis] for x in (old_effort, old_practice, own_proxy,
+                                   talent))
+
+    def best_effort(practice, rows=slice(None), trig=None):
+        return solve_effort(practice, old_effort[rows], own_proxy[rows],
+                            index.select(rows), select_rows(model, rows),
+                            select_rows(goal_scale, rows), talent[rows], trig)
+
+    if trig is not None:
+        trig = tuple(x[:, np.newaxis] for x in trig)
+    utility, effort = best_effort(old_practice, trig=trig)
+    practice = old_practice.copy()
+    if agency.any():
+        rows = np.flatnonzero(agency)
+        rank = np.arange(len(rows))[:, np.newaxis]
+        if learned is not None:
+            angles = np.concatenate((old_practice[rows], learned), axis=1)
+        else:
+            angles = gaming_angles(old_practice[rows])
+        utilities, efforts = best_effort(angles, rows)
+        best = np.argmax(utilities, axis=1)[:, np.newaxis]
+        utility[rows] = utilities[rank, best]
+        effort[rows] = efforts[rank, best]
+        practice[rows] = angles[rank, best]
+        if learned is None:
+            at = best[:, 0]
+            ends = (angles[rank[:, 0], np.maximum(at-1, 0)],
+                    angles[rank[:, 0], np.minimum(at+1, angles.shape[1]-1)])
+            refined, angle = brent_maximum(
+                lambda angle, subset: best_effort(angle, rows[subset])[0],
+                np.minimum(*ends)[:, np.newaxis],
+                np.maximum(*ends)[:, np.newaxis], scan=2)
+            refined, refined_effort = best_effort(angle, rows)
+            better = refined[:, 0] > utility[rows, 0]
+            utility[rows[better]] = refined[better]
+            effort[rows[better]] = refined_effort[better]
+            practice[rows[better]] = angle[better]
+    return utility[:, 0], effort[:, 0], practice[:, 0]
+
+
+def initial_traits(model, rng=None):
+    """ practice and talent of all initial agents, one call each on the
+    model's random generator (or rng) """
+    rng = model.rng if rng is None else rng
+    practice = rng.uniform(0, model.goal_angle, model.num_agents)
+    talent = floor_talent(rng.normal(10, model.talent_sd, model.num_agents))
+    return practice, talent
+
+
+def floor_talent(talent):
+    """ no negative talent: negative talents (array, set in place) become
+    0.01; returns talent """
+    talent[talent < 0] = 0.01
+    return talent
+
+
+def offspring_traits(rng, model, n):
+    """ practice mutations and talents of n offspring, one call each on
+    rng """
+    mutation = rng.normal(0, model.practice_mutation_rate, n)
+    talent = floor_talent(rng.normal(10, model.talent_sd, n))
+    return mutation, talent
+
+
+def draw_offspring(proxy, survival_threshold, model, rng=None):
+    """ selection phase of kill_and_replace with every random number drawn
+    in one call: death coins of all potential losers, one random winner per
+    dying loser, practice mutations and talents of the offspring.
+    Returns dying losers, their winners, mutations and talents.
+    rng: random generator to draw from (default: model.rng) """
+    potential_losers = np.flatnonzero(proxy <= survival_threshold)
+    potential_winners = np.flatnonzero(proxy >= survival_threshold)
+    rng = model.rng if rng is None else rng
+    dies = rng.random(len(potential_losers)) < model.selection_pressure
+    losers = potential_losers[dies]
+    winners = potential_winners[rng.integers(len(potential_winners),
+                                             size=len(losers))]
+    mutation, talent = offspring_traits(rng, model, len(losers))
+    return losers, winners, mutation, talent
+
+
+def draw_fitness_offspring(proxy, model):
+    """ fitness proportionate selection with every random number drawn in
+    one call: the number of events (each agent starts one with probability
+    selection_pressure*competition), the winners (proportional to proxy, one
+    search in the cumulative proxies), the losers (uniform), practice
+    mutations and talents of the offspring.
+    Returns losers, winners, mutations and talents; a loser drawn twice
+    ends up as the offspring of its last winner. """
+    if (proxy < 0).any():
+        raise ValueError('fitness proportionate selection needs '
+                         'non-negative proxies')
+    n = len(proxy)
+    rng = model.rng
+    events = rng.binomial(n, model.selection_pressure*model.competition)
+    cumulative = np.cumsum(proxy)
+    if cumulative[-1] > 0:
+        winners = np.searchsorted(cumulative,
+                                  rng.random(events)*cumulative[-1],
+                                  side='right')
+        winners = np.minimum(winners, n-1)
+    else:
+        winners = rng.integers(n, size=events)  # all equally fit
+    losers = rng.integers(n, size=events)  # p=inv_rel_proxies
+    mutation, talent = offspring_traits(rng, model, events)
+    return losers, winners, mutation, talent
+
+
+def offspring_practice(parent_practice, mutation):
+    """ mutated practice of offspring, kept within 360° """
+    practice = parent_practice + mutation
+    return np.where(practice > np.pi*2, practice - np.pi*2, practice)
+
+
+class ProxyPopulation:
+    """
+    Population class
+    - hold agent properties as arrays (practice, effort, talent, proxy,..
+    - step agents (optimize effort/practice to maximize utility)
+    - implement selection on the arrays
+    """
+    def __init__(self, model, practice, talent):
+        """ practice, talent: initial traits of all agents (see
+        initial_traits) """
+        self.model = model
+        n = model.num_agents
+        dtype = model.dtype
+        self.unique_id = np.arange(n)
+        self.practice, self.talent = (x.astype(dtype) for x
+                                      in (practice, talent))
+        ''' cached trig terms, updated whenever practice changes '''
+        self.cos_practice, self.sin_practice, self.cos_goal = trig_terms(
+            self.practice, model)
+        self.effort = np.zeros(n, dtype=dtype)
+        self.proxy = self.cos_practice * self.effort
+        self.previous_step_proxy = np.zeros(n, dtype=dtype)
+        self.goal = self.cos_goal * self.effort
+        self.goal_oc = self.sin_practice * self.effort
+        self.utility = np.full(n, np.nan, dtype=dtype)
+        self.child_of = self.unique_id.copy()
+        ''' active set: agents that kept effort and practice at their last
+        optimization (newborns are not settled), and the survival threshold
+        they saw then '''
+        self.settled = np.zeros(n, dtype=bool)
+        self.seen_threshold = np.full(n, np.nan, dtype=dtype)
+
+    def __len__(self):
+        return len(self.unique_id)
+
+    def restore(self, state):
+        """ set the agent arrays given in state (dict of arrays, e.g. a
+        snapshot); proxy, goal and goal_oc follow from effort unless given """
+        if "effort" in state:
+            self.effort[:] = state["effort"]
+        self.proxy = self.cos_practice * self.effort
+        self.goal = self.cos_goal * self.effort
+        self.goal_oc = self.sin_practice * self.effort
+        for field, values in state.items():
+            getattr(self, field)[:] = values
+
+    def step(self, order, coins):
+        """ Actions to perform on each time step, agents in given order
+        coins: agency coin flip of each agent (uniform draws) """
+        model = self.model
+        if model.backend == "numba":
+            import ProxyKernels  # imports Numba, for this backend only
+            ProxyKernels.optimize_sweep(
+                order, coins[order], self.effort, self.practice,
+                self.cos_practice, self.sin_practice, self.cos_goal,
+                self.talent, self.proxy, self.previous_step_proxy, self.goal,
+                self.goal_oc, self.utility, model.proxy_index.ordered,
+                model.proxy_index.rank(model.competition), model.competition,
+                model.goal_angle, model.goal_scale, model.angle_agency,
+                model.update == "sequential", 2.,
+                ProxyKernels.PROSPECT_CODES[model.prospect],
+                model.prospect_exponent, model.loss_aversion,
+                model.prospect_scale, model.survival_uncertainty)
+        elif model.update == "synchronous":
+            ''' every agent best-responds to the proxies of the previous
+            step, so all agents are optimized in one go '''
+            self.previous_step_proxy[:] = self.proxy
+            agency = coins < model.angle_agency
+            agents = self.unique_id
+            if model.active_set:
+                agents = agents[self.active_agents(agency)]
+            self.optimize_effort(agents, agency[agents])
+        else:
+            ''' blocks of block_size agents in the given order, each
+            optimized against the proxies committed by the previous blocks
+            (one agent after another by default) '''
+            agency = coins < model.angle_agency
+            active = np.ones(len(self), dtype=bool)
+            if model.active_set:
+                active = self.active_agents(agency)
+            if model.block_size == 1:
+                for agent in order:
+                    self.previous_step_proxy[agent] = self.proxy[agent]
+                    if active[agent]:
+                        self.optimize_agent(agent, agency[agent])
+            else:
+                for start in range(0, len(order), model.block_size):
+                    block = order[start:start + model.block_size]
+                    self.previous_step_proxy[block] = self.proxy[block]
+                    block = block[active[block]]
+                    if len(block):
+                        self.optimize_effort(block, agency[block])
+
+    def survival_thresholds(self):
+        """ survival threshold every agent currently competes against: the
+        threshold of the population, or of its neighbourhood (one per
+        agent) under local competition """
+        model = self.model
+        if model.neighborhood is not None:
+            return model.neighborhood.thresholds(self.proxy,
+                                                 model.competition)
+        return model.proxy_index.threshold(model.competition)
+
+    def active_agents(self, agency):
+        """ ProxyModel(active_set=True): boolean array of the agents
+        optimized in this step. Near equilibrium most agents keep their
+        effort while the threshold barely moves; their best response is
+        carried forward unless they have agency in this step, are newborn
+        or moved at their last optimization (not settled), compete within
+        ACTIVE_WINDOW of the survival threshold, or the threshold moved by
+        more than ACTIVE_WINDOW since they were last optimized. """
+        threshold = self.survival_thresholds()
+        active = (agency | ~self.settled
+                  | (abs(self.proxy - threshold) <= ACTIVE_WINDOW)
+                  | ~(abs(threshold - self.seen_threshold) <= ACTIVE_WINDOW))
+        self.seen_threshold[active] = (threshold if np.ndim(threshold) == 0
+                                       else threshold[active])
+        return active
+
+    def optimize_effort(self, agents, agency):
+        """ Heuristic to optimize effort level (and potentially practice)
+        of the given agents, see ProxyAgent.optimize_effort
+        agency: boolean array, agents with agency over their practice
+        All agents respond to the proxies before the call: they are
+        evaluated in chunks of CHUNK_SIZE (bounded memory), then committed
+        together. """
+        if not len(agents):
+            return
+        results = [self.best_responses(agents[start:start + CHUNK_SIZE],
+                                       agency[start:start + CHUNK_SIZE])
+                   for start in range(0, len(agents), CHUNK_SIZE)]
+        utility, effort, practice = (np.concatenate(values) for values
+                                     in zip(*results))
+        self.commit(agents, utility, effort, practice)
+
+    def optimize_agent(self, agent, has_agency):
+        """ optimize_effort of a single agent (the sequential update one
+        agent after another): its candidates are evaluated directly and the
+        results are committed element by element, as ProxyAgent does,
+        without the bookkeeping of chunks and blocks """
+        model = self.model
+        agents = np.array([agent])
+        learned = None
+        if has_agency and model.learning == "social":
+            learned = model.learned_practices(agents)
+        trig = (self.cos_practice[agents], self.cos_goal[agents])
+        if model.optimizer == "solve":
+            utility, effort, practice = solve_candidates(
+                self.effort[agents], self.practice[agents],
+                np.array([has_agency]), self.proxy[agents],
+                model.competition_index(agents), model, model.goal_scale,
+                self.talent[agents], learned, trig)
+        else:
+            angles = candidate_angles(self.practice[agents],
+                                      np.array([has_agency]), learned)
+            utility, effort, practice = best_candidates(
+                self.effort[agents], self.practice[agents], angles,
+                self.proxy[agents], model.competition_index(agents), model,
+                model.goal_scale, self.talent[agents], trig)
+        effort, practice = effort[0], practice[0]
+        self.settled[agent] = (effort == self.effort[agent]
+                               and practice == self.practice[agent])
+        if practice != self.practice[agent]:
+            self.practice[agent] = practice
+            self.update_trig(agents)
+        old_proxy = self.proxy[agent]
+        self.proxy[agent] = self.cos_practice[agent] * effort
+        model.proxy_index.update(old_proxy, self.proxy[agent])
+        self.utility[agent] = utility[0]
+        self.effort[agent] = effort
+        self.goal[agent] = self.cos_goal[agent] * effort
+        self.goal_oc[agent] = self.sin_practice[agent] * effort
+
+    def best_responses(self, agents, agency):
+        """ utility, effort and practice of the best candidates of the
+        given agents (see optimize_effort) """
+        model = self.model
+        learned = None
+        if model.learning == "social" and agency.any():
+            learned = model.learned_practices(agents[agency])
+        if model.optimizer == "solve":
+            utility, effort, practice = solve_candidates(
+                self.effort[agents], self.practice[agents], agency,
+                self.proxy[agents], model.competition_index(agents), model,
+                model.goal_scale, self.talent[agents], learned,
+                (self.cos_practice[agents], self.cos_goal[agents]))
+        else:
+            utility, effort, practice = grid_candidates(
+                self.effort[agents], self.practice[agents], agency,
+                self.proxy[agents], model.competition_index(agents), model,
+                model.goal_scale, self.talent[agents], learned,
+                (self.cos_practice[agents], self.cos_goal[agents]))
+        return utility, effort, practice
+
+    def commit(self, agents, utility, effort, practice):
+        """ take the chosen effort and practice of the given agents and
+        update their proxies (and the ordered proxies under the sequential
+        update) """
+        model = self.model
+        self.settled[agents] = ((effort == self.effort[agents])
+                                & (practice == self.practice[agents]))
+        changed = agents[practice != self.practice[agents]]
+        self.practice[agents] = practice
+        if len(changed):
+            self.update_trig(changed)
+        new_proxy = self.cos_practice[agents] * effort
+        if model.update == "sequential":
+            model.proxy_index.replace(self.proxy[agents], new_proxy)
+        self.utility[agents] = utility
+        self.effort[agents] = effort
+        self.proxy[agents] = new_proxy
+        self.goal[agents] = self.cos_goal[agents] * effort
+        self.goal_oc[agents] = self.sin_practice[agents] * effort
+
+    def update_trig(self, agents):
+        """ recompute the cached trig terms of agents whose practice
+        changed """
+        (self.cos_practice[agents], self.sin_practice[agents],
+         self.cos_goal[agents]) = trig_terms(self.practice[agents],
+                                             self.model)
+
+    def reproduce(self, losers, winners, mutation, talent):
+        """ the losers become the offspring of the winners (inherit effort
+        and mutated practice, take the new random talent); all winners are
+        read before any loser is overwritten """
+        self.effort[losers] = self.effort[winners]
+        self.practice[losers] = offspring_practice(self.practice[winners],
+                                                   mutation)
+        self.talent[losers] = talent
+        self.child_of[losers] = self.unique_id[winners]
+        self.settled[losers] = False
+        self.update_trig(losers)
+
+    def kill_and_replace(self):
+        """ see ProxyModel.kill_and_replace """
+        model = self.model
+        rel_surv_thresh = model.competition
+        if model.neighborhood is not None:
+            neighborhood = model.neighborhood
+            survival_threshold = neighborhood.thresholds(self.proxy,
+                                                         rel_surv_thresh)
+            return self.reproduce(*neighborhood.offspring(
+                self.proxy, survival_threshold, model))
+        survival_threshold = model.proxy_index.threshold(rel_surv_thresh)
+        self.reproduce(*draw_offspring(self.proxy, survival_threshold,
+                                       model))
+
+    def fitness_proportionate_selection(self):
+        """ see ProxyModel.fitness_proportionate_selection """
+        self.reproduce(*draw_fitness_offspring(self.proxy, self.model))
+
+
+def population_field(name):
+    """ property of ProxyAgentView reading and writing the element of the
+    population array name that belongs to the agent """
+    def get(view):
+        return getattr(view.population, name)[view.unique_id]
+
+    def set(view, value):
+        getattr(view.population, name)[view.unique_id] = value
+    return property(get, set)
+
+
+class ProxyAgentView:
+    """
+    Flyweight view of one agent of a ProxyPopulation with the attributes of
+    ProxyAgent (proxy, goal, effort, practice,..), read from and written to
+    the population arrays. Views are created on access (see
+    ProxyAgentViews) and hold no agent state themselves.
+    """
+    __slots__ = ("population", "unique_id")
+
+    def __init__(self, population, unique_id):
+        self.population = population
+        self.unique_id = unique_id
+
+    effort = population_field("effort")
+    proxy = population_field("proxy")
+    previous_step_proxy = population_field("previous_step_proxy")
+    goal = population_field("goal")
+    goal_oc = population_field("goal_oc")
+    utility = population_field("utility")
+    talent = population_field("talent")
+    child_of = population_field("child_of")
+    cos_practice = population_field("cos_practice")
+    sin_practice = population_field("sin_practice")
+    cos_goal = population_field("cos_goal")
+
+    @property
+    def practice(self):
+        return self.population.practice[self.unique_id]
+
+    @practice.setter
+    def practice(self, practice):
+        ''' the cached trig terms follow the practice '''
+        self.population.practice[self.unique_id] = practice
+        self.population.update_trig([self.unique_id])
+
+    @property
+    def model(self):
+        return self.population.model
+
+    @property
+    def goal_scale(self):
+        return self.population.model.goal_scale
+
+    @property
+    def pos(self):
+        """ position on the grid (agents fill it row by row), None without
+        grid """
+        grid = self.population.model.grid
+        if grid is None:
+            return None
+        return (self.unique_id % grid.width, self.unique_id // grid.width)
+
+    def __eq__(self, other):
+        return (isinstance(other, ProxyAgentView)
+                and other.population is self.population
+                and other.unique_id == self.unique_id)
+
+    def __hash__(self):
+        return hash((id(self.population), self.unique_id))
+
+    def __repr__(self):
+        return 'ProxyAgentView(' + str(self.unique_id) + ')'
+
+
+class ProxyAgentViews:
+    """
+    model.agents of the array engine: the agents as a sequence of
+    ProxyAgentView in unique_id order, a view is created whenever an agent
+    is accessed (no object per agent is kept)
+    """
+    def __init__(self, population):
+        self.population = population
+
+    def __len__(self):
+        return len(self.population)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ProxyAgentView(self.population, i) for i
+                    in range(*index.indices(len(self)))]
+        if not -len(self) <= index < len(self):
+            raise IndexError('agent index out of range')
+        return ProxyAgentView(self.population, int(index) % len(self))
+
+    def __iter__(self):
+        population = self.population
+        return (ProxyAgentView(population, i) for i in range(len(self)))
+
+    def get(self, attr_names):
+        """ values of an attribute (or a list of attributes) of all agents,
+        like mesa's AgentSet.get """
+        if isinstance(attr_names, str):
+            values = getattr(self.population, attr_names, None)
+            if isinstance(values, np.ndarray):
+                return list(values)
+            return [getattr(agent, attr_names) for agent in self]
+        return [list(values) for values
+                in zip(*(self.get(name) for name in attr_names))]
+
+
+class AgentRecords:
+    """ agent records of one collection from the population arrays, kept as
+    one array per reporter (in the dtype of the population) and turned into
+    (step, agent id, values...) tuples when read """
+    def __init__(self, step, unique_id, columns):
+        self.step = step
+        self.unique_id = unique_id
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.unique_id)
+
+    def __iter__(self):
+        return zip([self.step] * len(self), self.unique_id.tolist(),
+                   *(column.tolist() if isinstance(column, np.ndarray)
+                     else column for column in self.columns))
+
+
+class ProxyDataCollector(DataCollector):
+    """ DataCollector that reads agent reporters given as attribute names
+    directly from the population arrays when the model runs on arrays
+    (stored as AgentRecords; other reporters are called on the agent views
+    of model.agents), and from model.agent_list otherwise """
+    def __init__(self, model_reporters=None, agent_reporters=None):
+        super().__init__(model_reporters=model_reporters,
+                         agent_reporters=agent_reporters)
+        self.agent_attributes = {name: reporter for name, reporter
+                                 in (agent_reporters or {}).items()
+                                 if isinstance(reporter, str)}
+
+    def _record_agents(self, model):
+        population = model.population
+        if population is None:
+            ''' agent objects, also those not registered with mesa '''
+            reporters = list(self.agent_reporters.values())
+            return ((model._steps, agent.unique_id)
+                    + tuple(reporter(agent) for reporter in reporters)
+                    for agent in model.agent_list)
+        columns = []
+        for name, reporter in self.agent_reporters.items():
+            values = getattr(population, self.agent_attributes.get(name, ""),
+                             None)
+            if isinstance(values, np.ndarray):
+                columns.append(values.copy())
+            else:
+                columns.append([reporter(agent) for agent in model.agents])
+        return AgentRecords(model._steps, population.unique_id, columns)
+
+    def collect(self, model):
+        """ see DataCollector.collect; agent records of the array engine
+        are kept as AgentRecords instead of a list of tuples """
+        if model.population is None or not self.agent_reporters:
+            return super().collect(model)
+        agent_reporters, self.agent_reporters = self.agent_reporters, {}
+        try:
+            super().collect(model)
+        finally:
+            self.agent_reporters = agent_reporters
+        self._agent_records[model._steps] = self._record_agents(model)
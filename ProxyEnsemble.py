@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, ensemble engine
+Runs many replicates together: the agents of all replicates are packed into
+one flat array per agent property (replicate r owns the segment
+offsets[r]:offsets[r+1]), and every step optimizes the same agent position
+of all replicates at once instead of one model after another. Replicates
+may differ in their seed and in the parameters of SWEEP_PARAMETERS, so a
+whole parameter sweep (e.g. the competition family of S6 or the numAgents
+family of S9) runs as one ensemble.
+Replicate r draws its random numbers from its own Generator seeded with
+seeds[r], in the same order as ProxyModel(seed=seeds[r], engine="arrays"),
+so it follows the same trajectory as that model.
+ensemble_run is a drop-in for batch_run(ProxyModel, ...).
+"""
+
+import numpy as np
+from mesa.batchrunner import _make_model_kwargs
+from ProxyArrays import (grid_candidates, solve_candidates, initial_traits,
+                         trig_terms, draw_offspring, offspring_practice,
+                         survival_rank, PROSPECTS)
+from ProxyNeighbors import NeighborhoodIndex
+
+''' parameters that may take one value per replicate (numAgents is stored
+as num_agents) '''
+SWEEP_PARAMETERS = ("numAgents", "competition", "talent_sd", "goal_scale",
+                    "goal_angle", "selection_pressure",
+                    "practice_mutation_rate", "angle_agency")
+''' parameters shared by all replicates that the array functions read '''
+SHARED_PARAMETERS = ("prospect", "loss_aversion", "prospect_exponent",
+                     "prospect_scale", "survival_uncertainty")
+
+
+def sequential_mean(ensemble, values):
+    """ means of the segments of every replicate, added up one element after
+    another like the sum() of the model reporters (np.sum adds pairwise and
+    may differ in the last bit); segments are padded with zeros to the
+    largest one, which leaves the sums unchanged """
+    padded = np.zeros((ensemble.replicates, np.max(ensemble.num_agents)),
+                      dtype=values.dtype)
+    padded[ensemble.replicate, ensemble.unique_id] = values
+    means = np.cumsum(padded, axis=1)[:, -1]/ensemble.num_agents
+    return means.astype(values.dtype)
+
+
+def circular_mean(ensemble, values):
+    """ mean angle of the segment of every replicate (np.mean per segment,
+    whose pairwise sums depend on the segment length) """
+    return np.array([np.arctan2(np.mean(np.sin(values[segment])),
+                                np.mean(np.cos(values[segment])))
+                     for segment in ensemble.segments()])
+
+
+''' model level readouts, one value per replicate (see the compute_...
+functions of S5_ProxyModel1.py) '''
+ENSEMBLE_REPORTERS = {
+    "mean_proxy_value": lambda e: sequential_mean(e, e.proxy),
+    "mean_goal_value": lambda e: sequential_mean(e, e.goal),
+    "mean_goal_oc": lambda e: sequential_mean(e, e.goal_oc),
+    "mean_effort": lambda e: sequential_mean(e, e.effort),
+    "mean_utility": lambda e: sequential_mean(e, e.utility),
+    "mean_practice": lambda e: circular_mean(e, e.practice),
+    "mean_talent": lambda e: sequential_mean(e, e.talent),
+}
+
+
+class ReplicateParameters:
+    """
+    The parameters of the ensemble as seen by the functions of ProxyArrays
+    (in place of the model): those of SWEEP_PARAMETERS for some agents (one
+    value per agent, of the replicate in rows) or for one replicate (rows:
+    an int), the others shared.
+    """
+    def __init__(self, ensemble, rows):
+        self.ensemble = ensemble
+        self.rows = rows
+        for name in SHARED_PARAMETERS:
+            setattr(self, name, getattr(ensemble, name))
+        self.num_agents = ensemble.num_agents[rows]
+        for name in SWEEP_PARAMETERS:
+            if name != "numAgents":
+                setattr(self, name, getattr(ensemble, name)[rows])
+
+    def select(self, rows):
+        """ parameters of a subset of the agents """
+        return ReplicateParameters(self.ensemble, self.rows[rows])
+
+
+class ProxyEnsemble:
+    """
+    Ensemble class
+    - hold the agent properties of R replicates as flat arrays, replicate
+      after replicate (ragged if their numAgents differ)
+    - step all replicates (optimize effort/practice, selection)
+    - collect the model level readouts of every replicate
+    Takes the parameters of ProxyModel, with one seed per replicate; those
+    of SWEEP_PARAMETERS may be given once or one per replicate (they are
+    stored as arrays with one value per replicate).
+    Supports global competition with the "gaming" agency mode and the numpy
+    backend (engine is ignored, the replicates always run on arrays); dtype
+    as in ProxyModel. active_set, block_size, threshold_error,
+    initial_state and competition_graph are accepted at their defaults
+    only.
+    """
+    def __init__(self, seeds,
+                 data_collect_interval,
+                 width, height,
+                 competition,
+                 numAgents, talent_sd,
+                 goal_scale,
+                 goal_angle,
+                 selection_pressure,
+                 practice_mutation_rate,
+                 angle_agency,
+                 max_steps,
+                 engine="arrays",
+                 update="sequential",
+                 backend="numpy",
+                 prospect="kahneman_tversky",
+                 loss_aversion=2.25, prospect_exponent=0.88,
+                 prospect_scale=1, survival_uncertainty=1,
+                 optimizer="grid", competition_radius=None, moore=True,
+                 learning="gaming", learning_radius=1, learning_sample=None,
+                 dtype="float64", active_set=False, block_size=1,
+                 threshold_error=None, initial_state=None,
+                 competition_graph=None):
+        if update not in ("sequential", "synchronous"):
+            raise ValueError('unknown update: ' + str(update))
+        if prospect not in PROSPECTS:
+            raise ValueError('unknown prospect: ' + str(prospect))
+        if optimizer not in ("grid", "solve"):
+            raise ValueError('unknown optimizer: ' + str(optimizer))
+        if backend != "numpy":
+            raise ValueError('ensemble supports only backend "numpy"')
+        if competition_radius is not None or learning != "gaming":
+            raise ValueError('ensemble supports only global competition '
+                             'and learning "gaming"')
+        if dtype not in ("float64", "float32", np.float64, np.float32):
+            raise ValueError('unknown dtype: ' + str(dtype))
+        if competition_graph is not None:
+            raise ValueError('ensemble supports only global competition')
+        if active_set or block_size != 1 or threshold_error is not None:
+            raise ValueError('ensemble supports only exact thresholds of '
+                             'all agents, block_size 1 and no active_set')
+        if initial_state is not None:
+            raise ValueError('ensemble supports only random initial agents')
+        self.dtype = np.dtype(dtype)
+        self.data_collect_interval = data_collect_interval
+        self.max_steps = max_steps
+        self.update = update
+        self.prospect = prospect
+        self.loss_aversion = loss_aversion
+        self.prospect_exponent = prospect_exponent
+        self.prospect_scale = prospect_scale
+        self.survival_uncertainty = survival_uncertainty
+        self.optimizer = optimizer
+        self.running = True
+        self.steps = 0
+
+        ''' one random generator per replicate, seeded like ProxyModel '''
+        self.rngs = [np.random.default_rng(None if seed is None else int(seed))
+                     for seed in seeds]
+        self.replicates = len(self.rngs)
+        sweep = dict(numAgents=numAgents, competition=competition,
+                     talent_sd=talent_sd, goal_scale=goal_scale,
+                     goal_angle=goal_angle,
+                     selection_pressure=selection_pressure,
+                     practice_mutation_rate=practice_mutation_rate,
+                     angle_agency=angle_agency)
+        for name in SWEEP_PARAMETERS:
+            value = np.asarray(sweep[name],
+                               dtype=int if name == "numAgents" else float)
+            if value.ndim > 0 and value.shape != (self.replicates,):
+                raise ValueError(name + ' needs one value per replicate')
+            value = np.broadcast_to(value, self.replicates).copy()
+            setattr(self, "num_agents" if name == "numAgents" else name,
+                    value)
+
+        ''' packed layout: replicate and agent number (within its replicate)
+        of every entry of the flat arrays '''
+        self.offsets = np.concatenate(([0], np.cumsum(self.num_agents)))
+        self.replicate = np.repeat(np.arange(self.replicates),
+                                   self.num_agents)
+        self.unique_id = (np.arange(self.offsets[-1])
+                          - self.offsets[self.replicate])
+        size = self.offsets[-1]
+        self.practice = np.empty(size, dtype=self.dtype)
+        self.talent = np.empty(size, dtype=self.dtype)
+        for r, (rng, segment) in enumerate(zip(self.rngs, self.segments())):
+            self.practice[segment], self.talent[segment] = initial_traits(
+                ReplicateParameters(self, r), rng)
+        ''' parameters of the utility in the precision of the agent arrays,
+        once the initial traits are drawn (competition stays float64, it
+        sets the rank of the threshold) '''
+        self.goal_scale = self.goal_scale.astype(self.dtype)
+        self.goal_angle = self.goal_angle.astype(self.dtype)
+        self.cos_practice, self.sin_practice, self.cos_goal = trig_terms(
+            self.practice, ReplicateParameters(self, self.replicate))
+        self.effort = np.zeros(size, dtype=self.dtype)
+        self.proxy = self.cos_practice * self.effort
+        self.previous_step_proxy = np.zeros(size, dtype=self.dtype)
+        self.goal = self.cos_goal * self.effort
+        self.goal_oc = self.sin_practice * self.effort
+        self.utility = np.full(size, np.nan, dtype=self.dtype)
+        self.child_of = self.unique_id.copy()
+
+        ''' proxies of every replicate ordered within its segment (see
+        ProxyRankIndex) '''
+        self.ordered = self.segment_sort(self.proxy)
+        self.model_vars = {name: [] for name in ENSEMBLE_REPORTERS}
+
+    def segments(self):
+        """ slices of the flat arrays holding the agents of each replicate """
+        return [slice(start, stop) for start, stop
+                in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def segment_sort(self, values):
+        """ values sorted within the segment of every replicate """
+        return values[np.lexsort((values, self.replicate))]
+
+    def ordered_position(self, rows, values):
+        """ number of ordered proxies of replicates rows below values (like
+        np.searchsorted in every segment; one binary search per value, all
+        run together) """
+        low = self.offsets[rows]
+        high = self.offsets[rows+1]
+        last = len(self.ordered)-1
+        for _ in range(int(np.max(self.num_agents)).bit_length()):
+            searching = low < high
+            middle = (low + high) // 2
+            right = searching & (self.ordered[np.minimum(middle, last)]
+                                 < values)
+            low = np.where(right, middle+1, low)
+            high = np.where(searching & ~right, middle, high)
+        return low - self.offsets[rows]
+
+    def rank(self):
+        """ index of the survival threshold in the ordered proxies of every
+        replicate """
+        return survival_rank(self.competition, self.num_agents)
+
+    def competition_index(self, rows, own):
+        """ index the agents of replicates rows with ordered position own
+        (see ProxyRankIndex.neighbours) compete in, one row per agent """
+        n = self.num_agents[rows]
+        k = self.rank()[rows]
+        start = self.offsets[rows]
+        below = start + np.clip(k-1 + (k-1 >= own), 0, n-1)
+        above = start + np.clip(k + (k >= own), 0, n-1)
+        lower = np.where(k > 0, self.ordered[below], -np.inf)
+        upper = np.where(k < n-1, self.ordered[above], np.inf)
+        return NeighborhoodIndex(lower[:, np.newaxis], upper[:, np.newaxis])
+
+    def collect(self):
+        """ model level readouts of every replicate """
+        for name, reporter in ENSEMBLE_REPORTERS.items():
+            self.model_vars[name].append(reporter(self))
+
+    def step(self):
+        """ one step of every replicate, see ProxyModel.step """
+        self.collect()
+        order = np.zeros((self.replicates, np.max(self.num_agents)),
+                         dtype=int)
+        coins = np.empty(len(self.proxy))
+        for r, (rng, segment) in enumerate(zip(self.rngs, self.segments())):
+            n = self.num_agents[r]
+            order[r, :n] = rng.permutation(n)
+            coins[segment] = rng.random(n)
+        agency = coins < self.angle_agency[self.replicate]
+
+        if self.update == "synchronous":
+            ''' all agents of all replicates in one go '''
+            self.previous_step_proxy[:] = self.proxy
+            own = self.ordered_position(self.replicate, self.proxy)
+            self.optimize_effort(self.replicate, np.arange(len(self.proxy)),
+                                 agency, own)
+            self.ordered = self.segment_sort(self.proxy)
+        else:
+            ''' the agent at the same position of every replicate at once
+            (of the replicates with more agents than that position) '''
+            for position in range(order.shape[1]):
+                rows = np.flatnonzero(self.num_agents > position)
+                agents = self.offsets[rows] + order[rows, position]
+                self.previous_step_proxy[agents] = self.proxy[agents]
+                own = self.ordered_position(rows, self.proxy[agents])
+                self.optimize_effort(rows, agents, agency[agents], own)
+        self.kill_and_replace()
+        self.steps += 1
+        if self.steps >= self.max_steps:
+            self.running = False
+
+    def optimize_effort(self, rows, agents, agency, own):
+        """ optimize_effort of the agents (flat indices) of replicates rows,
+        see ProxyPopulation.optimize_effort; own: ordered position of their
+        proxies within their replicate """
+        index = self.competition_index(rows, own)
+        parameters = ReplicateParameters(self, rows)
+        trig = (self.cos_practice[agents], self.cos_goal[agents])
+        if self.optimizer == "solve":
+            utility, effort, practice = solve_candidates(
+                self.effort[agents], self.practice[agents], agency,
+                self.proxy[agents], index, parameters, parameters.goal_scale,
+                self.talent[agents], None, trig)
+        else:
+            utility, effort, practice = grid_candidates(
+                self.effort[agents], self.practice[agents], agency,
+                self.proxy[agents], index, parameters, parameters.goal_scale,
+                self.talent[agents], None, trig)
+
+        changed = practice != self.practice[agents]
+        self.practice[agents] = practice
+        if changed.any():
+            self.update_trig(rows[changed], agents[changed])
+        new_proxy = self.cos_practice[agents] * effort
+        if self.update == "sequential":
+            self.update_ordered(rows, own, new_proxy)
+        self.utility[agents] = utility
+        self.effort[agents] = effort
+        self.proxy[agents] = new_proxy
+        self.goal[agents] = self.cos_goal[agents] * effort
+        self.goal_oc[agents] = self.sin_practice[agents] * effort
+
+    def update_ordered(self, rows, own, new_proxy):
+        """ replace the entry at position own of the ordered proxies of
+        replicates rows by new_proxy (see ProxyRankIndex.update, one entry
+        per replicate, the entries in between of all of them shifted by one
+        in one go) """
+        start = self.offsets[rows]
+        new = self.ordered_position(rows, new_proxy)
+        up = new > own
+        ''' count entries from first on move one step down if up, one step
+        up otherwise '''
+        first = start + np.where(up, own, new+1)
+        count = np.where(up, new-1-own, own-new)
+        moved = (np.repeat(first - np.cumsum(count) + count, count)
+                 + np.arange(np.sum(count)))
+        shift = np.repeat(np.where(up, 1, -1), count)
+        self.ordered[moved] = self.ordered[moved + shift]
+        self.ordered[start + np.where(up, new-1, new)] = new_proxy
+
+    def update_trig(self, rows, agents):
+        """ recompute the cached trig terms of agents (of replicates rows)
+        whose practice changed """
+        (self.cos_practice[agents], self.sin_practice[agents],
+         self.cos_goal[agents]) = trig_terms(self.practice[agents],
+                                             ReplicateParameters(self, rows))
+
+    def kill_and_replace(self):
+        """ selection in every replicate, see ProxyModel.kill_and_replace;
+        the random numbers of replicate r come from its own generator """
+        survival_threshold = self.ordered[self.offsets[:-1] + self.rank()]
+        losers, winners, mutations, talents = [], [], [], []
+        for r, (rng, segment) in enumerate(zip(self.rngs, self.segments())):
+            loser, winner, mutation, talent = draw_offspring(
+                self.proxy[segment], survival_threshold[r],
+                ReplicateParameters(self, r), rng)
+            losers.append(loser + segment.start)
+            winners.append(winner + segment.start)
+            mutations.append(mutation)
+            talents.append(talent)
+        losers, winners = np.concatenate(losers), np.concatenate(winners)
+
+        ''' offspring of all replicates, parents read before any write '''
+        self.effort[losers] = self.effort[winners]
+        self.practice[losers] = offspring_practice(self.practice[winners],
+                                                   np.concatenate(mutations))
+        self.talent[losers] = np.concatenate(talents)
+        self.child_of[losers] = self.unique_id[winners]
+        self.update_trig(self.replicate[losers], losers)
+
+
+def ensemble_run(parameters, iterations=1, data_collection_period=-1,
+                 max_steps=1000):
+    """ batch_run(ProxyModel, parameters, iterations, ...) with all runs
+    that differ only in their seed and in SWEEP_PARAMETERS (e.g. all runs of
+    S6, S7 or S9) run as one ProxyEnsemble. Returns the same records as
+    batch_run: one per run, RunIds in the same order, Step -1 (ProxyModel
+    does not advance mesa's step counter, so batch_run reports the last
+    collected model level values of every run) and no agent level data.
+    data_collection_period and max_steps are accepted like in batch_run
+    and have no effect there either: runs stop after the max_steps model
+    parameter. """
+    runs = []
+    for iteration in range(iterations):
+        for kwargs in _make_model_kwargs(parameters):
+            runs.append((len(runs), iteration, kwargs))
+
+    ''' runs that differ only in seed and swept parameters share an
+    ensemble '''
+    families = {}
+    for run in runs:
+        key = tuple((name, value) for name, value in run[2].items()
+                    if name != "seed" and name not in SWEEP_PARAMETERS)
+        families.setdefault(key, []).append(run)
+
+    results = {}
+    for key, family_runs in families.items():
+        sweep = {name: [kwargs[name] for _, _, kwargs in family_runs]
+                 for name in SWEEP_PARAMETERS if name in family_runs[0][2]}
+        ensemble = ProxyEnsemble([kwargs["seed"] for _, _, kwargs
+                                  in family_runs], **dict(key), **sweep)
+        while ensemble.running:
+            ensemble.step()
+        for r, (run_id, iteration, kwargs) in enumerate(family_runs):
+            model_data = {name: values[-1][r] for name, values
+                          in ensemble.model_vars.items()}
+            results[run_id] = {"RunId": run_id, "iteration": iteration,
+                               "Step": -1, **kwargs, **model_data}
+    return [results[run_id] for run_id in sorted(results)]
+
+
+def dtype_report(parameters, iterations=1,
+                 readouts=("mean_proxy_value", "mean_goal_value",
+                           "mean_practice")):
+    """ validation of dtype="float32": runs parameters (as in ensemble_run)
+    in float64 and in float32 and compares the final model level readouts.
+    Returns one record per run with its parameters and, for every readout,
+    the float64 and float32 values and their absolute difference. """
+    reference = ensemble_run(dict(parameters, dtype="float64"), iterations)
+    reduced = ensemble_run(dict(parameters, dtype="float32"), iterations)
+    records = []
+    for run, run32 in zip(reference, reduced):
+        record = {name: value for name, value in run.items()
+                  if name not in ENSEMBLE_REPORTERS and name != "dtype"}
+        for name in readouts:
+            record[name + "_float64"] = float(run[name])
+            record[name + "_float32"] = float(run32[name])
+            record[name + "_difference"] = abs(float(run32[name])
+                                               - float(run[name]))
+        records.append(record)
+    return records
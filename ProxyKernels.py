@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, compiled kernels
+Optional Numba version of the loop that dominates long runs of the array
+engine: the agent loop of optimize_effort (selection in kill_and_replace is
+vectorized, see ProxyArrays.draw_offspring). Used by
+ProxyModel(engine="arrays", backend="numba").
+The kernel is compiled on first use and cached on disk (__pycache__), so
+later processes (e.g. batch_run workers) load it without compiling.
+Numba itself is only imported then, not by models of the numpy backend.
+Without Numba, NUMBA_AVAILABLE is False and the model keeps the numpy code.
+"""
+
+import functools
+import importlib.util
+import math
+import numpy as np
+from ProxyArrays import TEST_LIST, CHANGE_ANGLE
+
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None
+
+
+def njit(function):
+    """ decorator compiling function with numba.njit (cached on disk) when
+    it is first called """
+    kernel = []
+
+    @functools.wraps(function)
+    def call(*args):
+        if not kernel:
+            import numba
+            kernel.append(numba.njit(cache=True)(function))
+        return kernel[0](*args)
+    return call
+
+
+''' prospect functions of ProxyArrays.PROSPECTS the kernel implements '''
+PROSPECT_CODES = {"kahneman_tversky": 0, "mcdermott": 1, "step": 2,
+                  "linear": 3}
+
+
+@njit
+def optimize_sweep(order, coins, effort, practice, cos_practice,
+                   sin_practice, cos_goal, talent, proxy,
+                   previous_step_proxy, goal, goal_oc, utility, ordered,
+                   k, competition, goal_angle, goal_scale, angle_agency,
+                   sequential, cost_exponent, prospect_code,
+                   prospect_exponent, loss_aversion, prospect_scale,
+                   survival_uncertainty):
+    """ optimize_effort for all agents in the given order, in place.
+    coins: one uniform draw per position in order (agency coin flips)
+    ordered: sorted proxies (ProxyRankIndex.ordered), updated after every
+    agent if sequential, left frozen otherwise.
+    k: index of the survival threshold in ordered (ProxyArrays.survival_rank)
+    cos_practice, sin_practice, cos_goal: cached trig terms of practice,
+    used without agency and updated when practice changes.
+    prospect_code: see PROSPECT_CODES, followed by the prospect parameters.
+    cost_exponent (2.) is passed at run time, so that effort**2 is computed
+    by pow like in the numpy kernel instead of being folded into e*e. """
+    n = len(ordered)
+    for position in range(len(order)):
+        i = order[position]
+        previous_step_proxy[i] = proxy[i]
+        own_proxy = proxy[i]
+
+        ''' neighbours of the threshold among the other agents '''
+        own = np.searchsorted(ordered, own_proxy)
+        lower = -np.inf
+        if k > 0:
+            lower = ordered[k-1 + (1 if k-1 >= own else 0)]
+        upper = np.inf
+        if k < n-1:
+            upper = ordered[k + (1 if k >= own else 0)]
+
+        n_angles = 1
+        if coins[position] < angle_agency:
+            n_angles = len(CHANGE_ANGLE)
+        old_effort = effort[i]
+        old_practice = practice[i]
+        own_entry = own_proxy
+        max_utility = -1000.
+        new_effort = 0.
+        new_practice = old_practice
+        for a in range(n_angles):
+            test_angle = old_practice
+            cos_test = cos_practice[i]
+            cos_test_goal = cos_goal[i]
+            if n_angles > 1:
+                test_angle = np.deg2rad(old_practice/np.pi*180
+                                        - CHANGE_ANGLE[a])
+                cos_test = np.cos(test_angle)
+                cos_test_goal = np.cos(goal_angle - test_angle)
+            for t in range(len(TEST_LIST)):
+                test_effort = old_effort + TEST_LIST[t]
+                if test_effort > 0:
+                    own_candidate = cos_test * test_effort
+                    survival_threshold = max(lower, min(own_entry, upper))
+                    own_entry = own_candidate
+                    distance = own_candidate-survival_threshold
+                    if competition <= 0:
+                        prospect = 0.  # no competition
+                    elif prospect_code == 0:
+                        prospect = abs(distance)**prospect_exponent
+                        if distance < 0:
+                            prospect = -prospect * loss_aversion
+                    elif prospect_code == 1:
+                        prospect = prospect_scale * math.erf(
+                            distance/survival_uncertainty)
+                        if distance < 0:
+                            prospect = -abs(prospect) * loss_aversion
+                    elif prospect_code == 2:
+                        prospect = 1. if distance >= 0 else -1.
+                    else:
+                        prospect = distance
+                    test_utility = (prospect
+                                    + goal_scale*(cos_test_goal * test_effort)
+                                    - test_effort**cost_exponent/talent[i])
+                    if np.isnan(test_utility):
+                        print('error: utility is nan')
+                    if test_utility > max_utility:
+                        max_utility = test_utility
+                        new_effort = test_effort
+                        new_practice = test_angle
+
+        if new_practice != old_practice:
+            cos_practice[i] = np.cos(new_practice)
+            sin_practice[i] = np.sin(new_practice)
+            cos_goal[i] = np.cos(goal_angle - new_practice)
+        new_proxy = cos_practice[i] * new_effort
+        if sequential:
+            ''' move the own entry to its new rank '''
+            j = np.searchsorted(ordered, new_proxy)
+            if j > own:
+                ordered[own:j-1] = ordered[own+1:j]
+                ordered[j-1] = new_proxy
+            else:
+                ordered[j+1:own+1] = ordered[j:own].copy()
+                ordered[j] = new_proxy
+        utility[i] = max_utility
+        effort[i] = new_effort
+        practice[i] = new_practice
+        proxy[i] = new_proxy
+        goal[i] = cos_goal[i] * new_effort
+        goal_oc[i] = sin_practice[i] * new_effort
+
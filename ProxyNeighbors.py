@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, neighbourhoods
+With ProxyModel(competition_radius=r) agents compete only within their
+neighbourhood on the toroidal grid instead of within the whole population,
+with ProxyModel(learning="social") they learn practices from neighbours.
+The neighbourhoods are computed once as an index table (one row of agent
+indices per agent), so that survival thresholds of all agents are read from
+the proxy array with one fancy index and one sort.
+On the grid, agent i sits at (i % width, i // width), so grid
+neighbourhoods require numAgents = width*height.
+With ProxyModel(competition_graph=adjacency) agents compete within their
+neighbourhood on an arbitrary graph (e.g. small-world or scale-free) given
+as a sparse CSR adjacency: rows of different lengths, kept as one flat
+array of neighbour indices, with thresholds from one segmented sort.
+"""
+
+import numpy as np
+from ProxyArrays import offspring_traits, survival_rank
+
+
+def neighbor_table(width, height, radius, moore=True, include_center=True):
+    """ indices of the agents in the neighbourhood of every agent on a
+    toroidal width x height grid (like grid.get_neighbors(pos, moore,
+    include_center, radius)). One row per agent, sorted by agent index. """
+    if 2*radius+1 > min(width, height):
+        raise ValueError('neighbourhood radius wraps around the grid')
+    offset = np.arange(-radius, radius+1)
+    dx, dy = (d.ravel() for d in np.meshgrid(offset, offset))
+    if not moore:
+        ''' von Neumann neighbourhood '''
+        keep = abs(dx) + abs(dy) <= radius
+        dx, dy = dx[keep], dy[keep]
+    if not include_center:
+        keep = (dx != 0) | (dy != 0)
+        dx, dy = dx[keep], dy[keep]
+    n = width*height
+    x = np.arange(n) % width
+    y = np.arange(n) // width
+    table = (((y[:, np.newaxis] + dy) % height)*width
+             + (x[:, np.newaxis] + dx) % width)
+    dtype = np.int32 if n < 2**31 else np.int64
+    return np.sort(table, axis=1).astype(dtype)
+
+
+def sample_table(n, size, rng):
+    """ indices of size random other agents for each of n agents (drawn
+    once with replacement, e.g. the fixed contacts for social learning) """
+    table = rng.integers(n-1, size=(n, size))
+    ''' skip the agent itself '''
+    table += table >= np.arange(n)[:, np.newaxis]
+    dtype = np.int32 if n < 2**31 else np.int64
+    return table.astype(dtype)
+
+
+class ProxyNeighborhood:
+    """
+    Neighbourhoods of all agents (see neighbor_table) and the local survival
+    thresholds: the rank int(competition*K)-1 (as in the whole population)
+    among the K proxies of a neighbourhood.
+    """
+    def __init__(self, width, height, radius, moore=True):
+        self.table = neighbor_table(width, height, radius, moore)
+        self.size = self.table.shape[1]
+
+    def rank(self, competition):
+        """ index of the survival threshold in an ordered neighbourhood """
+        return survival_rank(competition, self.size)
+
+    def thresholds(self, proxy, competition):
+        """ survival threshold of every agent's neighbourhood
+        (proxy: proxies of all agents) """
+        return np.sort(proxy[self.table], axis=1)[:, self.rank(competition)]
+
+    def members(self, agents):
+        """ agents in the neighbourhoods of the given agents (one row per
+        agent) """
+        return self.table[agents]
+
+    def offspring(self, proxy, survival_threshold, model):
+        """ selection within the neighbourhoods, see draw_local_offspring """
+        return draw_local_offspring(proxy, survival_threshold, self.table,
+                                    model)
+
+    def index(self, agents, proxies, competition):
+        """ NeighborhoodIndex of some agents; proxies: the proxies of their
+        neighbourhoods (of the members, own entry included) """
+        own_proxy = proxies[self.table[agents] == agents[:, np.newaxis]]
+        ordered = np.sort(proxies, axis=1)
+        rows = np.arange(len(ordered))
+        k = self.rank(competition)
+        ''' position of the own entry, the others are ordered without it '''
+        own = np.sum(ordered < own_proxy[:, np.newaxis], axis=1)
+        lower = np.full(len(ordered), -np.inf)
+        upper = np.full(len(ordered), np.inf)
+        if k > 0:
+            lower = ordered[rows, k-1 + (k-1 >= own)]
+        if k < self.size-1:
+            upper = ordered[rows, k + (k >= own)]
+        return NeighborhoodIndex(lower[:, np.newaxis], upper[:, np.newaxis])
+
+
+def segment_entries(starts, sizes):
+    """ positions of the entries of several segments (rows of a flat
+    array, given by their starts and sizes), concatenated """
+    offsets = np.cumsum(sizes) - sizes
+    return np.arange(np.sum(sizes)) + np.repeat(starts - offsets, sizes)
+
+
+class ProxyGraphNeighborhood:
+    """
+    Neighbourhoods on a graph: every agent competes with itself and its
+    neighbours in the adjacency (CSR rows, any lengths). The neighbourhoods
+    are stored in CSR form as well (indptr, indices, sorted by agent index),
+    and the survival threshold of each is the rank int(competition*K)-1
+    among its K proxies, as on the grid.
+    """
+    def __init__(self, adjacency, n):
+        """ adjacency: scipy sparse matrix or (indptr, indices) of the
+        n x n adjacency (row i: the agents agent i competes with) """
+        if isinstance(adjacency, tuple):
+            indptr, indices = (np.asarray(x) for x in adjacency)
+        else:
+            adjacency = adjacency.tocsr()
+            indptr, indices = adjacency.indptr, adjacency.indices
+        if len(indptr) != n+1 or (len(indices) and not
+                                  0 <= indices.min() <= indices.max() < n):
+            raise ValueError('competition graph does not match numAgents')
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        ''' closed neighbourhoods: own entry added, duplicates dropped '''
+        rows = np.concatenate((rows, np.arange(n)))
+        indices = np.concatenate((indices, np.arange(n)))
+        order = np.lexsort((indices, rows))
+        rows, indices = rows[order], indices[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (indices[1:] != indices[:-1])
+        dtype = np.int32 if len(rows) < 2**31 else np.int64
+        self.rows = rows[keep].astype(dtype)
+        self.indices = indices[keep].astype(dtype)
+        self.size = np.bincount(self.rows, minlength=n)
+        self.indptr = np.concatenate(([0], np.cumsum(self.size)))
+
+    def rank(self, competition, agents=slice(None)):
+        """ index of the survival threshold in the ordered neighbourhoods of
+        the given agents """
+        return survival_rank(competition, self.size[agents])
+
+    def members(self, agents):
+        """ agents in the neighbourhoods of the given agents, one segment
+        per agent (concatenated) """
+        return self.indices[segment_entries(self.indptr[agents],
+                                            self.size[agents])]
+
+    def thresholds(self, proxy, competition):
+        """ survival threshold of every agent's neighbourhood (segmented
+        sort of the neighbourhood proxies, proxy: proxies of all agents) """
+        proxies = proxy[self.indices]
+        ordered = proxies[np.lexsort((proxies, self.rows))]
+        return ordered[self.indptr[:-1] + self.rank(competition)]
+
+    def index(self, agents, proxies, competition):
+        """ NeighborhoodIndex of some agents; proxies: the proxies of their
+        members (own entries included) """
+        size = self.size[agents]
+        segment = np.repeat(np.arange(len(agents)), size)
+        starts = np.cumsum(size) - size
+        ordered = proxies[np.lexsort((proxies, segment))]
+        own_proxy = proxies[self.members(agents) == np.repeat(agents, size)]
+        k = self.rank(competition, agents)
+        ''' position of the own entry, the others are ordered without it '''
+        own = np.bincount(segment, ordered < own_proxy[segment],
+                          minlength=len(agents)).astype(int)
+        last = starts + size - 1
+        lower = np.where(k > 0, ordered[np.minimum(
+            starts + k-1 + (k-1 >= own), last)], -np.inf)
+        upper = np.where(k < size-1, ordered[np.minimum(
+            starts + k + (k >= own), last)], np.inf)
+        return NeighborhoodIndex(lower[:, np.newaxis], upper[:, np.newaxis])
+
+    def offspring(self, proxy, survival_threshold, model):
+        """ selection on the graph, all random numbers drawn in one call
+        each (as in draw_local_offspring): agents at or below the threshold
+        of their neighbourhood die with probability selection_pressure, each
+        is replaced by the offspring of a random winner of its
+        neighbourhood (at or above the same threshold). Returns dying
+        losers, their winners, mutations and talents. """
+        rng = model.rng
+        potential_losers = np.flatnonzero(proxy <= survival_threshold)
+        dies = rng.random(len(potential_losers)) < model.selection_pressure
+        losers = potential_losers[dies]
+        neighbors = self.members(losers)
+        size = self.size[losers]
+        segment = np.repeat(np.arange(len(losers)), size)
+        is_winner = proxy[neighbors] >= survival_threshold[losers][segment]
+        pick = rng.integers(np.bincount(segment, is_winner,
+                                        minlength=len(losers)).astype(int))
+        ''' the pick-th winner (from 0) within the segment of each loser '''
+        winners_before = np.cumsum(is_winner)
+        start = np.cumsum(size) - size
+        target = winners_before[start] - is_winner[start] + pick + 1
+        winners = neighbors[np.searchsorted(winners_before, target)]
+        mutation, talent = offspring_traits(rng, model, len(losers))
+        return losers, winners, mutation, talent
+
+
+class NeighborhoodIndex:
+    """
+    Survival thresholds of some agents (rows) within their neighbourhoods,
+    answering the queries of ProxyRankIndex the optimizers use: the proxies
+    just below and at the threshold among the other agents of the
+    neighbourhood (arrays with one row per agent).
+    """
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+
+    def select(self, rows):
+        """ index of a subset of the agents """
+        return NeighborhoodIndex(self.lower[rows], self.upper[rows])
+
+    def neighbours(self, own_proxy, competition):
+        """ see ProxyRankIndex.neighbours """
+        return self.lower, self.upper
+
+    def leave_one_out(self, own_proxy, competition, proxy):
+        """ see ProxyRankIndex.leave_one_out """
+        return np.maximum(self.lower, np.minimum(proxy, self.upper))
+
+
+def draw_local_offspring(proxy, survival_threshold, table, model):
+    """ selection phase of kill_and_replace under local competition, every
+    random number drawn in one call: agents at or below the threshold of
+    their neighbourhood die with probability selection_pressure, each is
+    replaced by the offspring of a random winner of its neighbourhood (at
+    or above the same threshold). survival_threshold: one per agent.
+    Returns dying losers, their winners, mutations and talents. """
+    rng = model.rng
+    potential_losers = np.flatnonzero(proxy <= survival_threshold)
+    dies = rng.random(len(potential_losers)) < model.selection_pressure
+    losers = potential_losers[dies]
+    neighbors = table[losers]
+    is_winner = proxy[neighbors] >= survival_threshold[losers, np.newaxis]
+    pick = rng.integers(is_winner.sum(axis=1))
+    position = np.argmax(np.cumsum(is_winner, axis=1) > pick[:, np.newaxis],
+                         axis=1)
+    winners = neighbors[np.arange(len(losers)), position]
+    mutation, talent = offspring_traits(rng, model, len(losers))
+    return losers, winners, mutation, talent
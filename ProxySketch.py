@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, approximate survival thresholds
+With ProxyModel(threshold_error=e) the survival thresholds are read from a
+quantile sketch of the proxies instead of the sorted proxies of all agents:
+a few sorted levels of samples that answer every rank query within
+e*numAgents ranks, in memory independent of the population size (about
+log2(numAgents)**2/e values). Used by the optimizers (prospects) and by
+kill_and_replace alike; the collected threshold_flips readout counts the
+agents whose winner/loser status differs from the exact threshold.
+"""
+
+import numpy as np
+from ProxyArrays import survival_rank
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch (compactors as in KLL): level h holds sorted
+    items standing for 2**h values each. Whenever a level fills a block of
+    capacity items, the block is sorted and every second item moves up one
+    level (alternately the odd and even ones). A compaction shifts any rank
+    by at most 2**h, error_bound sums these shifts over all compactions.
+    """
+    def __init__(self, error, size):
+        """ error: rank error as a fraction of the size (upper bound of the
+        number of values) the sketch is guaranteed to stay within """
+        levels = max(np.log2(max(size, 2)), 1)
+        self.capacity = 2*int(np.ceil(levels/error/2))
+        self.levels = []
+        self.compactions = []
+        self.count = 0
+        self.error_bound = 0
+        self.items = None
+
+    def __len__(self):
+        return self.count
+
+    def update(self, values):
+        """ add values (array) to the sketch """
+        self.count += len(values)
+        self.add(0, np.asarray(values))
+
+    def merge(self, other):
+        """ add the values summarized by another sketch (of the same
+        capacity) """
+        self.count += other.count
+        self.error_bound += other.error_bound
+        for h, items in enumerate(other.levels):
+            self.add(h, items)
+
+    def add(self, h, items):
+        """ add items to level h and compact the full blocks upwards """
+        while len(items):
+            if h == len(self.levels):
+                self.levels.append(items[:0])
+                self.compactions.append(0)
+            items = np.concatenate((self.levels[h], items))
+            full = len(items) // self.capacity * self.capacity
+            blocks = np.sort(items[:full].reshape(-1, self.capacity), axis=1)
+            self.levels[h] = np.sort(items[full:])
+            ''' alternate the kept half from block to block '''
+            odd = (self.compactions[h] + np.arange(len(blocks))) % 2 == 1
+            items = np.where(odd[:, np.newaxis], blocks[:, 1::2],
+                             blocks[:, ::2]).ravel()
+            self.compactions[h] += len(blocks)
+            self.error_bound += len(blocks) * 2**h
+            h += 1
+        self.items = None
+
+    def compile(self):
+        """ all items in order with their cumulative weights """
+        if self.items is None:
+            items = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(items), 2**h) for h, items
+                                      in enumerate(self.levels)])
+            order = np.argsort(items, kind="stable")
+            self.items = items[order]
+            self.cumulative = np.cumsum(weights[order])
+        return self.items, self.cumulative
+
+    def rank(self, value):
+        """ approximate number of values below value (may be an array) """
+        items, cumulative = self.compile()
+        position = np.searchsorted(items, value)
+        return np.where(position > 0, cumulative[position-1], 0)
+
+    def value(self, rank):
+        """ approximate value at the given rank (0 based, may be an array)
+        among the ordered values """
+        items, cumulative = self.compile()
+        position = np.searchsorted(cumulative, rank, side="right")
+        return items[np.minimum(position, len(items)-1)]
+
+
+''' values added to a sketch per update call (bounds the memory of the
+level 0 blocks) '''
+SKETCH_CHUNK = 2**16
+
+
+class SketchRankIndex:
+    """
+    Approximate ProxyRankIndex of the synchronous update: survival threshold
+    and its neighbours among the other agents read from a QuantileSketch of
+    all proxies (ranks off by at most error*N). The sketch can not remove
+    entries, so it is built anew every step instead of being updated.
+    """
+    def __init__(self, proxies, error):
+        self.size = len(proxies)
+        self.sketch = QuantileSketch(error, self.size)
+        for start in range(0, self.size, SKETCH_CHUNK):
+            self.sketch.update(proxies[start:start + SKETCH_CHUNK])
+
+    def __len__(self):
+        return self.size
+
+    def rank(self, competition):
+        """ see ProxyRankIndex.rank """
+        return survival_rank(competition, len(self))
+
+    def threshold(self, competition):
+        """ approximate survival threshold of the current population """
+        return self.sketch.value(self.rank(competition))
+
+    def select(self, rows):
+        """ see ProxyRankIndex.select """
+        return self
+
+    def neighbours(self, own_proxy, competition):
+        """ see ProxyRankIndex.neighbours """
+        n = len(self)
+        k = self.rank(competition)
+        own = self.sketch.rank(own_proxy)
+        lower = (self.sketch.value(k-1 + (k-1 >= own)) if k > 0
+                 else -np.inf)
+        upper = self.sketch.value(k + (k >= own)) if k < n-1 else np.inf
+        return lower, upper
+
+    def leave_one_out(self, own_proxy, competition, proxy):
+        """ see ProxyRankIndex.leave_one_out """
+        lower, upper = self.neighbours(own_proxy, competition)
+        return np.maximum(lower, np.minimum(proxy, upper))
+
+
+def exact_threshold(proxies, competition):
+    """ exact survival threshold (selection of one order statistic, without
+    sorting all proxies) """
+    k = survival_rank(competition, len(proxies))
+    return np.partition(proxies, k)[k]
+
+
+def threshold_flips(proxies, competition, threshold):
+    """ number of agents whose winner/loser status (proxy at or below the
+    survival threshold) differs between threshold and the exact one """
+    exact = exact_threshold(proxies, competition)
+    return int(np.count_nonzero((proxies <= threshold) != (proxies <= exact)))
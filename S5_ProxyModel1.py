@@ -12,77 +12,127 @@ the Agent class, System level properties and computations in the Model class.
 from mesa import Agent, Model
 from mesa.time import RandomActivation
 from mesa.space import SingleGrid
-import random
-from mesa.datacollection import DataCollector
+import json
+import os
+import warnings
 import numpy as np
+import ProxyKernels
+from ProxyNeighbors import (ProxyNeighborhood, ProxyGraphNeighborhood,
+                            neighbor_table, sample_table)
+from ProxyArrays import (ProxyPopulation, ProxyDataCollector, ProxyRankIndex,
+                         ProxyAgentViews, gaming_angles, best_candidates,
+                         draw_offspring, draw_fitness_offspring,
+                         offspring_practice, solve_candidates,
+                         initial_traits, floor_talent, trig_terms, PROSPECTS)
+from ProxySketch import SketchRankIndex, threshold_flips
 
 ''' Functions computing model level readouts for data collection '''
 
 
+def agent_values(model, attribute):
+    """ Returns the values of an agent attribute across agents
+    (the population array if the model runs on the array engine) """
+    if model.population is not None:
+        return getattr(model.population, attribute)
+    return [getattr(agent, attribute) for agent in model.agent_list]
+
+
+def agent_sum(values):
+    """ Returns the sum of agent values, added up one after another like
+    sum() (for the population arrays in one numpy call) """
+    if isinstance(values, np.ndarray) and len(values):
+        return np.cumsum(values)[-1]
+    return sum(values)
+
+
 def compute_mean_proxy_value(model):
     """ Returns the mean total proxy value across agents """
-    proxy_values = [agent.proxy for agent in model.agents]
-    return sum(proxy_values)/model.num_agents
+    proxy_values = agent_values(model, "proxy")
+    return agent_sum(proxy_values)/model.num_agents
 
 
 def compute_mean_goal_value(model):
     """ Returns the mean goal value across agents """
-    goal_values = [agent.goal for agent in model.agents]
-    return sum(goal_values)/model.num_agents
+    goal_values = agent_values(model, "goal")
+    return agent_sum(goal_values)/model.num_agents
 
 
 def compute_mean_goal_oc(model):
     """ Returns the mean independent goal component across agents """
-    goal_oc = [agent.goal_oc for agent in model.agents]
-    return sum(goal_oc)/model.num_agents
+    goal_oc = agent_values(model, "goal_oc")
+    return agent_sum(goal_oc)/model.num_agents
 
 
 def compute_mean_effort(model):
     """ returns the mean effort across agents """
-    effort_values = [agent.effort for agent in model.agents]
-    return sum(effort_values)/model.num_agents
+    effort_values = agent_values(model, "effort")
+    return agent_sum(effort_values)/model.num_agents
 
 
 def compute_mean_utility(model):
     """ returns the mean utility across agents """
-    utility_values = [agent.utility for agent in model.agents]
-    return sum(utility_values)/model.num_agents
+    utility_values = agent_values(model, "utility")
+    return agent_sum(utility_values)/model.num_agents
 
 
 def compute_mean_practice(model):
     """ returns the mean practice angle across agents """
-    pr_vals = [agent.practice for agent in model.agents]
+    pr_vals = agent_values(model, "practice")
     return np.arctan2(np.mean(np.sin(pr_vals)), np.mean(np.cos(pr_vals)))
 
+
 def compute_mean_talent(model):
     """ returns the mean talent across agents """
-    t_vals = [agent.talent for agent in model.agents]
-    return sum(t_vals)/model.num_agents
+    t_vals = agent_values(model, "talent")
+    return agent_sum(t_vals)/model.num_agents
+
 
+def compute_threshold_flips(model):
+    """ Returns the number of agents whose winner/loser status under the
+    approximate survival threshold (threshold_error) differs from the exact
+    threshold """
+    proxies = np.asarray(agent_values(model, "proxy"))
+    return threshold_flips(proxies, model.competition,
+                           model.proxy_index.threshold(model.competition))
 
-class ProxyAgent(Agent):
+
+class ProxyAgentCore:
     """
-    Agent class
+    Agent state and behaviour shared by ProxyAgent and LeanProxyAgent
     - initialize agents (practice, effort,..
     - step agents (optimize effort/practice to maximize utility)
     """
-    def __init__(self, unique_id, model):
-        #test
-        super().__init__(unique_id, model)
-        self.practice = np.random.uniform(0, self.model.goal_angle)
+    __slots__ = ()
+
+    @property
+    def practice(self):
+        return self._practice
+
+    @practice.setter
+    def practice(self, practice):
+        ''' cached trig terms of practice, recomputed only when it is set '''
+        self._practice = practice
+        self.cos_practice, self.sin_practice, self.cos_goal = trig_terms(
+            practice, self.model)
+
+    def init_state(self, practice, talent, trig=None):
+        ''' practice and talent are drawn for all agents at once by the model
+        (see initial_traits), as are the trig terms of practice (trig) '''
+        if trig is None:
+            self.practice = practice
+        else:
+            self._practice = practice
+            self.cos_practice, self.sin_practice, self.cos_goal = trig
         # self.practice = self.model.goal_angle
-        self.talent = np.random.normal(10, self.model.talent_sd)
-        if self.talent < 0:
-            self.talent = 0.01
+        self.talent = talent
         self.effort = 0
-        self.proxy = np.cos(self.practice) * self.effort
+        self.proxy = self.cos_practice * self.effort
         self.previous_step_proxy = 0
-        self.goal = np.cos(self.model.goal_angle - self.practice) * self.effort
-        self.goal_oc = np.sin(self.practice) * self.effort
+        self.goal = self.cos_goal * self.effort
+        self.goal_oc = self.sin_practice * self.effort
         self.goal_scale = self.model.goal_scale
         self.utility = np.nan
         self.child_of = self.unique_id
-        
 
     def step(self):
         """ Actions to perform on each time step """
@@ -105,93 +155,90 @@ class ProxyAgent(Agent):
         If agents have agency over the practice angle, they similarly optimize
         by going through test_list at every angle in angle_list.
         """
-        test_list = [-10, -5, -1, -0.5, -0.1,
-                     0, 0.1, 0.5, 1, 5, 10]
-
         ''' agency >0 introduces agency over the practice angle 
         0 means no agency; 1 means full agency '''
         agency = self.model.angle_agency
         angle_list = [self.practice]
-        if np.random.rand() < agency:
+        has_agency = self.model.agency_coins[self.unique_id] < agency
+        learned = None
+        if has_agency and self.model.learning == "social":
             ''' social learning '''
-#            angle_list = neighbor_practices
+            learned = self.model.learned_practices(np.array([self.unique_id]))
+            angle_list = np.append(self.practice, learned[0])
+        elif has_agency:
             ''' individual learning (gaming) '''
-            own_practice = self.practice/np.pi*180
-            change_angle = [-5, -1, 0, 1, 5]
-            angle_list = [own_practice-x for x in change_angle]
-            angle_list = np.deg2rad(angle_list)
-
-
-        def get_prospect(self):
-            """ calculates the utility/disutility from the prospect of winning/
-            loosing competition """
-
-            #''' list of neighbors proxy performances '''
-            # neighbors = self.model.grid.get_neighbors(self.pos, moore=True, include_center=True, radius=2)
-            # proxies = list(n.proxy for n in neighbors)
-            agents = self.model.agents
-            proxies = list(n.proxy for n in agents)
-            self.proxy = np.cos(self.practice) * self.effort
-            own_proxy = self.proxy
-
-            rel_surv_thresh = self.model.competition
-            ordered = np.sort(proxies)
-            survival_threshold = ordered[int(rel_surv_thresh*len(proxies))-1]
-            
-            ''' survival threshold based on previous-step proxies '''
-            # ps_proxies = list(n.previous_step_proxy for n in agents)
-            # survival_threshold = ordered[int(rel_surv_thresh*len(ps_proxies))-1]
-            
-            if self.model.competition > 0:
-                ''' McDermott Prospect '''
-                # prospect = ps * ss.erf((own_proxy-survival_threshold)/survival_uncertainty)
-                ''' Kahneman Tversky Prospect '''
-                prospect = abs(own_proxy-survival_threshold)**0.88
-                ''' Step Prospect '''
-                # prospect = 1
-            else:
-                prospect = 0  # no competition
-            if (own_proxy-survival_threshold) < 0:  # loss aversion
-                prospect = -abs(prospect) * 2.25
-                # prospect = -1
-            return prospect
-
-        def get_utility(self, prospect):
-            ''' utility function '''
-            self.goal = np.cos(self.model.goal_angle - self.practice) * self.effort
-            gsc = self.goal_scale
-            e = self.effort
-            t = self.talent
-
-            utility = prospect + gsc*self.goal - (e**2)/t
-
-            return utility
-
-        old_effort = self.effort
-        new_effort = 0
-        new_practice = self.practice
-        max_utility = -1000
-        for test_angle in angle_list:
-            for test_effort in test_list:
-                self.effort = old_effort + test_effort
-                self.practice = test_angle
-                if self.effort > 0:
-                    prospect = get_prospect(self)
-                    utility = get_utility(self, prospect)
-                    if np.isnan(utility):
-                        print('error: utility is nan')
-                    if utility > max_utility:
-                        max_utility = utility
-                        new_effort = self.effort
-                        new_practice = self.practice
-
-        self.utility = max_utility
-        self.effort = new_effort
-        self.practice = new_practice
+            angle_list = gaming_angles(self.practice)
+
+        ''' all candidate efforts and angles are evaluated at once against
+        the sorted proxies of all other agents, or of the neighbours under
+        local competition (update="synchronous": survival threshold based
+        on previous-step proxies) '''
+        index = self.model.competition_index(np.array([self.unique_id]))
+        if self.model.optimizer == "solve":
+            ''' solve for the best effort (and practice) directly '''
+            max_utility, new_effort, new_practice = solve_candidates(
+                np.array([self.effort]), np.array([self.practice]),
+                np.array([has_agency]), np.array([self.proxy]), index,
+                self.model, self.goal_scale, np.array([self.talent]), learned,
+                (np.array([self.cos_practice]), np.array([self.cos_goal])))
+        else:
+            max_utility, new_effort, new_practice = best_candidates(
+                np.array([self.effort]), np.array([self.practice]),
+                np.atleast_2d(angle_list), np.array([self.proxy]), index,
+                self.model, self.goal_scale, np.array([self.talent]),
+                (np.array([self.cos_practice]), np.array([self.cos_goal])))
+
+        self.utility = max_utility[0]
+        self.effort = new_effort[0]
+        if new_practice[0] != self.practice:
+            self.practice = new_practice[0]
         self.oldproxy = self.proxy
-        self.proxy = np.cos(self.practice) * self.effort 
-        self.goal = np.cos(self.model.goal_angle - self.practice) * self.effort
-        self.goal_oc = np.sin(self.practice) * self.effort
+        self.proxy = self.cos_practice * self.effort 
+        if self.model.update == "sequential":
+            self.model.proxy_index.update(self.oldproxy, self.proxy)
+        self.goal = self.cos_goal * self.effort
+        self.goal_oc = self.sin_practice * self.effort
+
+
+class ProxyAgent(ProxyAgentCore, Agent):
+    """
+    Agent class: mesa Agent (registered with the model, can be placed on the
+    grid) with the state and behaviour of ProxyAgentCore
+    """
+    def __init__(self, unique_id, model, practice, talent, trig=None):
+        #test
+        super().__init__(unique_id, model)
+        self.init_state(practice, talent, trig)
+
+
+class LeanProxyAgent(ProxyAgentCore):
+    """
+    Slim agent of engine "lean": only the fields the model reads, in
+    __slots__, and not registered with mesa (the model keeps the agents in
+    agent_list, they have no grid position)
+    """
+    __slots__ = ("unique_id", "model", "_practice", "cos_practice",
+                 "sin_practice", "cos_goal", "talent", "effort", "proxy",
+                 "previous_step_proxy", "goal", "goal_oc", "goal_scale",
+                 "utility", "child_of", "oldproxy")
+
+    def __init__(self, unique_id, model, practice, talent, trig=None):
+        self.unique_id = unique_id
+        self.model = model
+        self.init_state(practice, talent, trig)
+
+
+def load_snapshot(path):
+    """ Returns the state saved by ProxyModel.save_snapshot (dict of
+    arrays), see the initial_state of ProxyModel """
+    with np.load(path) as snapshot:
+        return dict(snapshot)
+
+
+''' agent arrays of a snapshot (proxies are saved as well: offspring keep
+the proxy of the dead agent until they optimize) '''
+SNAPSHOT_FIELDS = ("practice", "talent", "effort", "proxy", "goal", "goal_oc",
+                   "utility", "child_of")
 
 
 class ProxyModel(Model):
@@ -199,6 +246,59 @@ class ProxyModel(Model):
     Model class
     - initialize model (agents on grid, time)
     - step model (implement selection/evolution, collect data)
+    engine: "agents" (one ProxyAgent object per agent), "lean" (one
+    LeanProxyAgent per agent, without mesa registration) or
+    "arrays" (struct-of-arrays ProxyPopulation, see ProxyArrays.py)
+    The grid is only built when width*height > 1.
+    update: "sequential" (agents see the proxies their predecessors chose
+    in the same step) or "synchronous" (all agents best-respond to the
+    proxies of the previous step)
+    block_size: agents optimized together under update "sequential"
+    (engine "arrays", numpy backend): blocks of block_size agents in the
+    random order, each responding to the proxies committed by the previous
+    blocks; 1 is the sequential update, numAgents the synchronous one
+    backend: "numpy" or "numba" (compiled optimize loop of the array
+    engine, see ProxyKernels.py; falls back to numpy without Numba)
+    prospect: name of the prospect function in ProxyArrays.PROSPECTS
+    ("kahneman_tversky", "mcdermott", "step" or "linear"), with its parameters
+    loss_aversion, prospect_exponent (Kahneman Tversky), prospect_scale and
+    survival_uncertainty (McDermott)
+    competition_radius: None (competition within the whole population) or
+    radius of the neighbourhoods agents compete in on the toroidal grid
+    (moore or von Neumann neighbourhood, requires numAgents = width*height;
+    see ProxyNeighbors.py)
+    competition_graph: None or the graph agents compete on instead, a
+    numAgents x numAgents sparse adjacency (scipy sparse matrix or CSR
+    (indptr, indices)): each agent competes within itself and its
+    neighbours, losers are replaced by offspring of winners among them
+    learning: how agents with agency (angle_agency) find new practices,
+    "gaming" (individual learning, small changes of the own practice) or
+    "social" (practices of the neighbours within learning_radius on the
+    grid, or of a fixed random sample of learning_sample other agents)
+    optimizer: "grid" (try the efforts of TEST_LIST around the current one)
+    or "solve" (solve for the best effort within the same range, and
+    practice within the gaming range under agency, see
+    ProxyArrays.solve_candidates). "solve" changes the outcomes: agents
+    search the whole range to within ProxyArrays.SOLVE_TOLERANCE instead of
+    trying the grid efforts, and under the synchronous update their best
+    responses need not settle
+    dtype: "float64" or "float32" (engine "arrays" only), precision of the
+    agent arrays and of the collected data
+    initial_state: None (initial practice and talent drawn at random) or
+    the initial population, a dict of arrays with one value per agent
+    (practice and talent, negative talents are set to 0.01; optionally
+    effort, utility, child_of and proxy, goal and goal_oc, which otherwise
+    follow from effort) or the path of a snapshot saved by save_snapshot;
+    a snapshot also restores the step count, the random generator and a
+    learning_sample, so that the run continues exactly
+    threshold_error: None (exact survival thresholds) or the rank error
+    (fraction of numAgents, between 0 and 1) of approximate thresholds read
+    from a quantile sketch of the proxies (update "synchronous", global
+    competition, numpy backend; see ProxySketch.py); adds the readout
+    threshold_flips
+    active_set: re-optimize only the agents whose best response may have
+    changed and carry the others forward (engine "arrays", numpy backend;
+    see ProxyPopulation.active_agents)
     """
     def __init__(self,
                  data_collect_interval,
@@ -210,50 +310,293 @@ class ProxyModel(Model):
                  selection_pressure,
                  practice_mutation_rate,
                  angle_agency,
-                 max_steps,seed):
+                 max_steps,seed,
+                 engine="agents",
+                 update="sequential",
+                 backend="numpy",
+                 prospect="kahneman_tversky",
+                 loss_aversion=2.25, prospect_exponent=0.88,
+                 prospect_scale=1, survival_uncertainty=1,
+                 optimizer="grid", competition_radius=None, moore=True,
+                 learning="gaming", learning_radius=1, learning_sample=None,
+                 dtype="float64", active_set=False, block_size=1,
+                 threshold_error=None, initial_state=None,
+                 competition_graph=None):
         
         self.data_collect_interval = data_collect_interval
         self.num_agents = numAgents
         self.selection_pressure = selection_pressure
-        self.grid = SingleGrid(width, height, True)  # toroidal (all ends rap)
+        self.grid = None
+        if width*height > 1:
+            self.grid = SingleGrid(width, height, True)  # toroidal (all ends rap)
         self.talent_sd = talent_sd
         self.practice_mutation_rate = practice_mutation_rate
         self.competition = competition
         self.angle_agency = angle_agency
         self.goal_scale = goal_scale
-        self.random = random.Random()
         self.running = True
         self.time = 0
         self.goal_angle = goal_angle
         self.max_steps = max_steps
         self.steps = 0
-        super().__init__(seed=1)
-        
+        self.engine = engine
+        self.update = update
+        self.population = None
+        if update not in ("sequential", "synchronous"):
+            raise ValueError('unknown update: ' + str(update))
+        self.backend = backend
+        if backend == "numba":
+            if engine != "arrays":
+                raise ValueError('backend "numba" requires engine "arrays"')
+            if not ProxyKernels.NUMBA_AVAILABLE:
+                warnings.warn('numba is not installed, using numpy backend')
+                self.backend = "numpy"
+        elif backend != "numpy":
+            raise ValueError('unknown backend: ' + str(backend))
+        if prospect not in PROSPECTS:
+            raise ValueError('unknown prospect: ' + str(prospect))
+        if (self.backend == "numba"
+                and prospect not in ProxyKernels.PROSPECT_CODES):
+            raise ValueError('backend "numba" does not implement prospect '
+                             + str(prospect))
+        self.prospect = prospect
+        self.loss_aversion = loss_aversion
+        self.prospect_exponent = prospect_exponent
+        self.prospect_scale = prospect_scale
+        self.survival_uncertainty = survival_uncertainty
+        if optimizer not in ("grid", "solve"):
+            raise ValueError('unknown optimizer: ' + str(optimizer))
+        if self.backend == "numba" and optimizer != "grid":
+            raise ValueError('backend "numba" requires optimizer "grid"')
+        self.optimizer = optimizer
+        self.neighborhood = None
+        if competition_radius is not None:
+            if width*height != numAgents:
+                raise ValueError('local competition requires '
+                                 'numAgents = width*height')
+            if self.backend == "numba":
+                raise ValueError('backend "numba" does not support '
+                                 'local competition')
+            self.neighborhood = ProxyNeighborhood(width, height,
+                                                  competition_radius, moore)
+        if competition_graph is not None:
+            if competition_radius is not None:
+                raise ValueError('competition_graph replaces '
+                                 'competition_radius')
+            if self.backend == "numba":
+                raise ValueError('backend "numba" does not support '
+                                 'local competition')
+            self.neighborhood = ProxyGraphNeighborhood(competition_graph,
+                                                       numAgents)
+        self.step_proxies = None
+        if learning not in ("gaming", "social"):
+            raise ValueError('unknown learning: ' + str(learning))
+        if learning == "social" and self.backend == "numba":
+            raise ValueError('backend "numba" does not support social '
+                             'learning')
+        if (learning == "social" and learning_sample is None
+                and width*height != numAgents):
+            raise ValueError('social learning on the grid requires '
+                             'numAgents = width*height')
+        self.learning = learning
+        self.learning_table = None
+        if dtype not in ("float64", "float32", np.float64, np.float32):
+            raise ValueError('unknown dtype: ' + str(dtype))
+        self.dtype = np.dtype(dtype)
+        if self.dtype != np.float64 and engine != "arrays":
+            raise ValueError('dtype ' + str(dtype) + ' requires engine '
+                             '"arrays"')
+        if active_set and (engine != "arrays" or self.backend == "numba"):
+            raise ValueError('active_set requires engine "arrays" and '
+                             'backend "numpy"')
+        self.active_set = active_set
+        if int(block_size) != block_size or block_size < 1:
+            raise ValueError('unknown block_size: ' + str(block_size))
+        if block_size > 1 and (engine != "arrays"
+                               or self.backend == "numba"):
+            raise ValueError('block_size requires engine "arrays" and '
+                             'backend "numpy"')
+        self.block_size = int(block_size)
+        if threshold_error is not None and not 0 < threshold_error < 1:
+            raise ValueError('threshold_error needs to be between 0 and 1: '
+                             + str(threshold_error))
+        if threshold_error is not None and (
+                update != "synchronous" or self.neighborhood is not None
+                or self.backend == "numba"):
+            raise ValueError('threshold_error requires update "synchronous", '
+                             'global competition and backend "numpy"')
+        self.threshold_error = threshold_error
+        self.step_practices = None
+        super().__init__(seed=seed)
+        ''' all random numbers of the model come from its own generator '''
+        self.rng = np.random.default_rng(None if seed is None else int(seed))
+        self.agency_coins = None
+        ''' agent objects in unique_id order (engines "agents" and "lean") '''
+        self.agent_list = []
+
+        if isinstance(initial_state, (str, os.PathLike)):
+            initial_state = load_snapshot(initial_state)
+        if initial_state is None:
+            practice, talent = initial_traits(self)
+        else:
+            missing = [f for f in ("practice", "talent")
+                       if f not in initial_state]
+            if missing:
+                raise ValueError('initial_state needs '
+                                 + ' and '.join(missing))
+            if any(len(initial_state[f]) != numAgents for f in SNAPSHOT_FIELDS
+                   if f in initial_state):
+                raise ValueError('initial_state does not match numAgents')
+            practice, talent = (np.array(initial_state[f], dtype=float)
+                                for f in ("practice", "talent"))
+            talent = floor_talent(talent)  # as for drawn agents
+        if self.dtype != np.float64:
+            ''' parameters of the utility in the precision of the agent
+            arrays, once the initial traits are drawn and before the trig
+            terms are cached (competition stays a float, it sets the rank
+            of the threshold) '''
+            self.goal_scale = self.dtype.type(goal_scale)
+            self.goal_angle = self.dtype.type(goal_angle)
+
+        if engine == "arrays":
+            ''' agents live in arrays, positions are implicit in the index '''
+            self.population = ProxyPopulation(self, practice, talent)
+        elif engine not in ("agents", "lean"):
+            raise ValueError('unknown engine: ' + str(engine))
+
         ''' Create agents on the grid '''
-        for i in range(self.num_agents):
-            A = ProxyAgent(i, self)
+        if self.population is None:
+            trig = list(zip(*trig_terms(practice, self)))
+        agent_class = LeanProxyAgent if engine == "lean" else ProxyAgent
+        for i in range(self.num_agents if self.population is None else 0):
+            A = agent_class(i, self, practice[i], talent[i], trig[i])
+            self.agent_list.append(A)
             ''' Add all agents row wise from top left to bottom right '''
-            if self.grid.width > 1 and self.grid.height > 1:
+            if (engine == "agents" and self.grid is not None
+                    and self.grid.width > 1 and self.grid.height > 1):
                 x = i % self.grid.width
-                y = int(i/self.grid.height)
+                y = int(i/self.grid.width)
                 self.grid.place_agent(A, (x, y))
 
-        self.datacollector = DataCollector(
-                model_reporters={"mean_proxy_value": compute_mean_proxy_value,
-                                 "mean_goal_value": compute_mean_goal_value,
-                                 "mean_goal_oc": compute_mean_goal_oc,
-                                 "mean_effort": compute_mean_effort,
-                                 "mean_utility": compute_mean_utility,
-                                 "mean_practice": compute_mean_practice,
-                                 "mean_talent": compute_mean_talent},
-                agent_reporters={"Proxy": lambda A: A.proxy,
-                                 "Goal": lambda A: A.goal,
-                                 "Goal_oc": lambda A: A.goal_oc,
-                                 "Utility": lambda A: A.utility,
-                                 "Effort": lambda A: A.effort,
-                                 "Practice": lambda A: A.practice,
-                                 "Genealogy": lambda A: A.child_of,
-                                 "Talent": lambda A: A.talent})
+        ''' neighbours agents learn practices from (drawn once) '''
+        if initial_state is not None and "learning_table" in initial_state:
+            self.learning_table = initial_state["learning_table"]
+        elif learning == "social" and learning_sample is not None:
+            self.learning_table = sample_table(self.num_agents,
+                                               int(learning_sample), self.rng)
+        elif learning == "social":
+            self.learning_table = neighbor_table(width, height,
+                                                 learning_radius, moore,
+                                                 include_center=False)
+
+        if initial_state is not None:
+            self.restore(initial_state)
+
+        ''' ordered proxies, updated whenever an agent commits a new proxy '''
+        self.proxy_index = self.rank_index()
+
+        model_reporters = {"mean_proxy_value": compute_mean_proxy_value,
+                           "mean_goal_value": compute_mean_goal_value,
+                           "mean_goal_oc": compute_mean_goal_oc,
+                           "mean_effort": compute_mean_effort,
+                           "mean_utility": compute_mean_utility,
+                           "mean_practice": compute_mean_practice,
+                           "mean_talent": compute_mean_talent}
+        if threshold_error is not None:
+            model_reporters["threshold_flips"] = compute_threshold_flips
+        self.datacollector = ProxyDataCollector(
+                model_reporters=model_reporters,
+                agent_reporters={"Proxy": "proxy",
+                                 "Goal": "goal",
+                                 "Goal_oc": "goal_oc",
+                                 "Utility": "utility",
+                                 "Effort": "effort",
+                                 "Practice": "practice",
+                                 "Genealogy": "child_of",
+                                 "Talent": "talent"})
+
+    @property
+    def agents(self):
+        """ agents of the model: the mesa AgentSet, with engine "lean" the
+        agent_list (the agents are not registered with mesa), with engine
+        "arrays" views of the agents over the population arrays (attributes
+        as ProxyAgent, see ProxyArrays.ProxyAgentViews) """
+        if self.population is not None:
+            return ProxyAgentViews(self.population)
+        if self.engine == "lean":
+            return self.agent_list
+        return super().agents
+
+    def restore(self, state):
+        """ agent values of an initial_state besides practice and talent
+        (proxy, goal and goal_oc follow from effort unless given), and the
+        step count and random generator of a snapshot """
+        fields = [f for f in SNAPSHOT_FIELDS[2:] if f in state]
+        if self.population is not None:
+            self.population.restore({f: state[f] for f in fields})
+        for i, agent in enumerate(self.agent_list):
+            if "effort" in state:
+                agent.effort = state["effort"][i]
+            agent.proxy = agent.cos_practice * agent.effort
+            agent.goal = agent.cos_goal * agent.effort
+            agent.goal_oc = agent.sin_practice * agent.effort
+            for f in fields:
+                setattr(agent, f, state[f][i])
+        if "steps" in state:
+            self.steps = int(state["steps"])
+            self.running = self.steps < self.max_steps
+        if "rng_state" in state:
+            self.rng.bit_generator.state = json.loads(str(state["rng_state"]))
+
+    def snapshot(self):
+        """ Returns the state of the model as a dict of arrays: the agent
+        arrays of SNAPSHOT_FIELDS, the step count, the state of the random
+        generator and the social learning table (see initial_state) """
+        state = {f: np.array(agent_values(self, f)) for f in SNAPSHOT_FIELDS}
+        state["steps"] = np.array(self.steps)
+        state["rng_state"] = np.array(json.dumps(self.rng.bit_generator.state))
+        if self.learning_table is not None:
+            state["learning_table"] = self.learning_table
+        return state
+
+    def save_snapshot(self, path):
+        """ Saves snapshot() to a numpy .npz file """
+        np.savez(path, **self.snapshot())
+
+    def rank_index(self):
+        """ index of the current proxies of all agents: ordered proxies
+        (ProxyRankIndex) or, with threshold_error, a SketchRankIndex """
+        proxies = agent_values(self, "proxy")
+        if self.threshold_error is not None:
+            return SketchRankIndex(np.asarray(proxies), self.threshold_error)
+        return ProxyRankIndex(proxies)
+
+    def competition_index(self, agents):
+        """ index the given agents (array of unique_ids) compete in: the
+        proxy_index of the population or, under local competition, a
+        NeighborhoodIndex of their neighbourhoods """
+        if self.neighborhood is None:
+            return self.proxy_index
+        members = self.neighborhood.members(agents)
+        if self.update == "synchronous":
+            proxies = self.step_proxies[members]
+        elif self.population is not None:
+            proxies = self.population.proxy[members]
+        else:
+            proxies = np.array([self.agent_list[j].proxy for j
+                                in members.ravel()]).reshape(members.shape)
+        return self.neighborhood.index(agents, proxies, self.competition)
+
+    def learned_practices(self, agents):
+        """ practices of the neighbours the given agents (array of
+        unique_ids) learn from, one row per agent """
+        table = self.learning_table[agents]
+        if self.update == "synchronous":
+            return self.step_practices[table]
+        if self.population is not None:
+            return self.population.practice[table]
+        return np.array([[self.agent_list[j].practice for j in row]
+                         for row in table])
 
     def kill_and_replace(self):
         """ recompute rank with chosen effort levels
@@ -262,71 +605,75 @@ class ProxyModel(Model):
         (new agents 1. inherit their practice and effort from the parent,
         2. draw new random talent,
         3. take the location & ID from the dead agent to facilitate display.
-        Deaths, births and genealogy are stored in "Genealogy")"""
-        agents = self.agents
-        proxies = list(n.proxy for n in agents)
+        Deaths, births and genealogy are stored in "Genealogy")
+        All random numbers of this selection phase are drawn at once and
+        offspring inherit from their parent as it was before selection."""
+        if self.population is not None:
+            return self.population.kill_and_replace()
+        agents = self.agent_list
+        proxies = np.array([n.proxy for n in agents])
         rel_surv_thresh = self.competition
-        ordered = np.sort(proxies)
-        survival_threshold = ordered[int(rel_surv_thresh*len(proxies))-1]
+        if self.neighborhood is not None:
+            ''' threshold of every agent's neighbourhood '''
+            survival_threshold = self.neighborhood.thresholds(
+                proxies, rel_surv_thresh)
+            return self.reproduce(agents, *self.neighborhood.offspring(
+                proxies, survival_threshold, self))
+        survival_threshold = self.proxy_index.threshold(rel_surv_thresh)
         # print(survival_threshold)
-        potential_losers = list(losers for losers in agents if losers.proxy <= survival_threshold)
-        potential_winners = list(losers for losers in agents if losers.proxy >= survival_threshold)
-        for potential_loser in potential_losers:
-            if np.random.rand() < self.selection_pressure:
-                loser = potential_loser
-                winner = random.choice(potential_winners)
-
-                ''' offspring: here the loser becomes the offspring of the winner '''
-                loser.effort = winner.effort
-                loser.practice = np.random.normal(winner.practice,
-                                                  self.practice_mutation_rate)
-                loser.talent = np.random.normal(10, self.talent_sd)
-
-                ''' practice within 360° '''
-                if loser.practice > np.pi*2:
-                    loser.practice = loser.practice - np.pi*2
-    
-                ''' no negative talent '''
-                if loser.talent < 0:
-                    loser.talent = 0.01
-                loser.child_of = winner.unique_id
-                
+        self.reproduce(agents, *draw_offspring(proxies, survival_threshold,
+                                               self))
+
     def fitness_proportionate_selection(self):
         """ recompute rank (i.e. proxy values) with chosen effort levels
         randomly choose agent proportional to fitness (i.e. proxy-value)
         chosen agent reproduces, replacing a randomly drawn other agent
         2. draw new random talent,
         3. take the location & ID from the dead agent to facilitate display.
-        Deaths, births and genealogy are stored in "Genealogy")"""
-        agents = self.agents
-        proxies = list(n.proxy for n in agents)
-        rel_proxies = [p/sum(proxies) for p in proxies]
-        inv_rel_proxies = [1-p for p in rel_proxies]
-        inv_rel_proxies = [p/sum(inv_rel_proxies) for p in inv_rel_proxies]
-        for potential_event in agents:
-            if np.random.rand() < self.selection_pressure * self.competition:
-                winner = np.random.choice(agents, p=rel_proxies)
-                loser = np.random.choice(agents)#, p=inv_rel_proxies)
-            
-                ''' offspring: here the loser becomes the offspring of the winner '''
-                loser.effort = winner.effort
-                loser.practice = np.random.normal(winner.practice,
-                                                  self.practice_mutation_rate)
-                loser.talent = np.random.normal(10, self.talent_sd)
-
-                ''' practice within 360° '''
-                if loser.practice > np.pi*2:
-                    loser.practice = loser.practice - np.pi*2
-    
-                ''' no negative talent '''
-                if loser.talent < 0:
-                    loser.talent = 0.01
-                loser.child_of = winner.unique_id
+        Deaths, births and genealogy are stored in "Genealogy")
+        The number of events, all winners (one search in the cumulative
+        proxies) and all losers are drawn at once, see
+        draw_fitness_offspring."""
+        if self.population is not None:
+            return self.population.fitness_proportionate_selection()
+        agents = self.agent_list
+        proxies = np.array([n.proxy for n in agents])
+        self.reproduce(agents, *draw_fitness_offspring(proxies, self))
+
+    def reproduce(self, agents, losers, winners, mutation, talent):
+        """ offspring: here the losers become the offspring of the winners
+        (agents: list of agents the indices refer to; parents are read
+        before any loser is overwritten) """
+        parents = [agents[w] for w in winners]
+        efforts = [winner.effort for winner in parents]
+        practices = offspring_practice(
+            np.array([winner.practice for winner in parents]), mutation)
+        for j, loser in enumerate(agents[l] for l in losers):
+            loser.effort = efforts[j]
+            loser.practice = practices[j]
+            loser.talent = talent[j]
+            loser.child_of = parents[j].unique_id
 
     def step(self):
         ''' adjust effort levels in random order '''
         self.datacollector.collect(self) #tried to make smart data collection but that would mean changing batchrunner
-        self.agents.shuffle_do("step")
+        ''' random order and agency coin flips of all agents in one block '''
+        order = self.rng.permutation(self.num_agents)
+        self.agency_coins = self.rng.random(self.num_agents)
+        if self.update == "synchronous":
+            self.step_proxies = np.array(agent_values(self, "proxy"))
+            if self.learning == "social":
+                self.step_practices = np.array(agent_values(self,
+                                                            "practice"))
+        if self.population is None:
+            agents = self.agent_list
+            for i in order:
+                agents[i].step()
+        else:
+            self.population.step(order, self.agency_coins)
+        if self.update == "synchronous":
+            ''' proxies were committed without updating the index '''
+            self.proxy_index = self.rank_index()
         self.kill_and_replace()
         self.steps += 1
         if self.steps >= self.max_steps:
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+proxyeconomics model, equivalence tests
+Short runs pinning the results that the engines, backends, ensembles, block
+sizes and snapshots are meant to share bit for bit, and the solved best
+responses against a brute force. Run with python -m pytest.
+"""
+
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from mesa.batchrunner import batch_run
+import ProxyArrays
+import ProxyKernels
+import S5_ProxyModel1 as pm
+from ProxyEnsemble import ProxyEnsemble, ensemble_run
+
+FIELDS = ("proxy", "goal", "goal_oc", "effort", "utility", "practice",
+          "talent", "child_of")
+
+PARAMETERS = dict(data_collect_interval=1, width=1, height=1,
+                  competition=0.9, numAgents=30, talent_sd=1, goal_scale=1,
+                  goal_angle=np.pi/4, selection_pressure=0.1,
+                  practice_mutation_rate=np.pi/90, angle_agency=0.5,
+                  max_steps=12)
+
+CASES = [{}, dict(angle_agency=0), dict(competition=0.0),
+         dict(competition=0.5, goal_scale=0, prospect="mcdermott"),
+         dict(update="synchronous"), dict(optimizer="solve", angle_agency=0),
+         dict(optimizer="solve", numAgents=8)]
+
+
+def make(seed=3, **kwargs):
+    return pm.ProxyModel(seed=seed, **dict(PARAMETERS, **kwargs))
+
+
+def run(model, steps):
+    for _ in range(steps):
+        model.step()
+    return model
+
+
+def state(model):
+    return {f: np.array(pm.agent_values(model, f), dtype=float)
+            for f in FIELDS}
+
+
+def assert_same_state(a, b):
+    state_a, state_b = state(a), state(b)
+    for f in FIELDS:
+        np.testing.assert_array_equal(state_a[f], state_b[f], err_msg=f)
+
+
+@pytest.mark.parametrize("case", CASES)
+@pytest.mark.parametrize("engine", ["lean", "arrays"])
+def test_engines_match_agents(engine, case):
+    a = run(make(engine="agents", **case), 10)
+    b = run(make(engine=engine, **case), 10)
+    assert_same_state(a, b)
+    for name, values in a.datacollector.model_vars.items():
+        np.testing.assert_array_equal(
+            np.array(values, dtype=float),
+            np.array(b.datacollector.model_vars[name], dtype=float),
+            err_msg=name)
+
+
+@pytest.mark.skipif(not ProxyKernels.NUMBA_AVAILABLE,
+                    reason="numba is not installed")
+def test_numba_backend_matches_numpy():
+    a = run(make(engine="arrays"), 10)
+    b = run(make(engine="arrays", backend="numba"), 10)
+    assert_same_state(a, b)
+
+
+@pytest.mark.parametrize("sweep", [
+    dict(competition=[0, 0.5, 0.9]),
+    dict(goal_scale=[-1, 2], talent_sd=[0.5, 3], update="synchronous"),
+    dict(numAgents=[7, 20], optimizer="solve", angle_agency=0)])
+def test_ensemble_run_matches_batch_run(sweep):
+    parameters = dict(PARAMETERS, engine="arrays", seed=[1, 2], **sweep)
+    a = batch_run(pm.ProxyModel, parameters, iterations=1,
+                  max_steps=PARAMETERS["max_steps"], display_progress=False)
+    b = ensemble_run(parameters)
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert x.keys() == y.keys()
+        for key in x:
+            np.testing.assert_array_equal(x[key], y[key], err_msg=key)
+
+
+@pytest.mark.parametrize("case", [{}, dict(angle_agency=0),
+                                  dict(learning="social", learning_sample=4)])
+def test_block_sizes(case):
+    """ block_size 1 is the sequential update, block_size numAgents the
+    synchronous one """
+    n = PARAMETERS["numAgents"]
+    assert_same_state(run(make(engine="agents", **case), 10),
+                      run(make(engine="arrays", block_size=1, **case), 10))
+    assert_same_state(
+        run(make(engine="arrays", update="synchronous", **case), 10),
+        run(make(engine="arrays", block_size=n, **case), 10))
+
+
+@pytest.mark.parametrize("engine", ["agents", "lean", "arrays"])
+def test_snapshot_continues_run(engine, tmp_path):
+    a = run(make(seed=7, engine=engine), 6)
+    path = tmp_path / "snapshot.npz"
+    a.save_snapshot(path)
+    run(a, 6)
+    b = run(make(seed=123, engine=engine, initial_state=path), 6)
+    assert a.steps == b.steps
+    assert_same_state(a, b)
+
+
+@pytest.mark.parametrize("case", [{}, dict(update="synchronous"),
+                                  dict(optimizer="solve", angle_agency=0)])
+def test_float32_ensemble_matches_model(case):
+    """ float32 with float64 goal_scale and goal_angle parameters """
+    kwargs = dict(PARAMETERS, dtype="float32", goal_scale=np.float64(1),
+                  goal_angle=np.float64(np.pi/4), **case)
+    seeds = [1, 2]
+    ensemble = ProxyEnsemble(seeds, **kwargs)
+    run(ensemble, 10)
+    for r, seed in enumerate(seeds):
+        model = run(pm.ProxyModel(engine="arrays", seed=seed, **kwargs), 10)
+        assert model.population.proxy.dtype == np.float32
+        for f in FIELDS:
+            np.testing.assert_array_equal(
+                getattr(model.population, f),
+                getattr(ensemble, f)[ensemble.segments()[r]], err_msg=f)
+
+
+@pytest.mark.parametrize("prospect", list(ProxyArrays.PROSPECTS))
+def test_solve_effort_matches_brute_force(prospect):
+    """ solved best responses against 20001 efforts on [old - 10, old + 10],
+    for agents above and below the survival threshold """
+    rng = np.random.default_rng(5)
+    model = SimpleNamespace(competition=0.5, prospect=prospect,
+                            loss_aversion=2.25, prospect_exponent=0.88,
+                            prospect_scale=1, survival_uncertainty=1,
+                            goal_angle=np.pi/4)
+    rows = 300
+    practice = rng.uniform(0, np.pi/2, (rows, 1))
+    old_effort = rng.uniform(0, 25, (rows, 1))
+    own = np.cos(practice)*old_effort
+    talent = rng.normal(10, 2, (rows, 1)).clip(1)
+    goal_scale = rng.uniform(-1, 2, (rows, 1))
+    index = ProxyArrays.ProxyRankIndex(
+        np.concatenate((rng.normal(10, 3, 30), own[:, 0])))
+    lower, upper = index.neighbours(own, model.competition)
+    assert (own < lower).any() and (own > upper).any()
+    solved, _ = ProxyArrays.solve_effort(practice, old_effort, own, index,
+                                         model, goal_scale, talent)
+    low = np.maximum(old_effort - 10, 0)
+    effort = low + (old_effort + 10 - low)*np.linspace(0, 1, 20001)
+    cos, _, cos_goal = ProxyArrays.trig_terms(practice, model)
+    proxy = cos*effort
+    threshold = np.maximum(lower, np.minimum(proxy, upper))
+    brute = ProxyArrays.candidate_utility(effort, cos_goal, proxy, threshold,
+                                          model, goal_scale, talent)
+    assert (brute.max(axis=1) - solved[:, 0]).max() < 1e-2